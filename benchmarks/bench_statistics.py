@@ -0,0 +1,129 @@
+# Copyright (C) 2021-2022 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+#
+# Hourly statistics from one year of hourly periods.
+#
+# Compares the groupby implementation hourly_statistic_data() replaced, the
+# HistoricalState path (live updates) and the array path (backfills).
+#
+# Run from the repository root (homeassistant from dev dependencies is required):
+#
+#   python benchmarks/bench_statistics.py
+#
+
+
+import itertools
+import sys
+import timeit
+from array import array
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from custom_components.ideenergy.historicaldata import (  # noqa: E402
+    HistoricalPeriods,
+    local_datetime_as_timestamp,
+)
+from custom_components.ideenergy.sensor import (  # noqa: E402
+    historical_states_from_periods,
+    hourly_statistic_data,
+    statistic_arrays_from_periods,
+)
+
+HOURS = 24 * 365
+NUMBER = 20
+
+
+def build_periods() -> HistoricalPeriods:
+    start = datetime(2023, 1, 1)
+    starts, ends, values = array("q"), array("q"), array("d")
+    for idx in range(HOURS):
+        period_start = start + timedelta(hours=idx)
+        starts.append(local_datetime_as_timestamp(period_start))
+        ends.append(local_datetime_as_timestamp(period_start + timedelta(hours=1)))
+        values.append(300.0 + idx % 7)
+
+    return HistoricalPeriods(starts, ends, values)
+
+
+def groupby_statistic_data(hist_states) -> list[dict]:
+    # Previous implementation, for reference
+    def hour_block_for_hist_state(hist_state):
+        if hist_state.dt.minute == 0 and hist_state.dt.second == 0:
+            dt = hist_state.dt - timedelta(hours=1)
+            return dt.replace(minute=0, second=0, microsecond=0)
+
+        return hist_state.dt.replace(minute=0, second=0, microsecond=0)
+
+    ret = []
+    total_accumulated = 0.0
+    for dt, collection_it in itertools.groupby(
+        hist_states, key=hour_block_for_hist_state
+    ):
+        collection = list(collection_it)
+        hour_accumulated = sum([x.state for x in collection])
+        total_accumulated = total_accumulated + hour_accumulated
+        ret.append({"start": dt, "state": hour_accumulated, "sum": total_accumulated})
+
+    return ret
+
+
+def from_historical_states(periods: HistoricalPeriods) -> list:
+    hist_states = [x for x in historical_states_from_periods(periods) if x.state]
+    return hourly_statistic_data(
+        array("q", (int(x.dt.timestamp()) for x in hist_states)),
+        array("d", (x.state for x in hist_states)),
+    )
+
+
+def from_arrays(periods: HistoricalPeriods) -> list:
+    return hourly_statistic_data(*statistic_arrays_from_periods(periods))
+
+
+def main() -> None:
+    periods = build_periods()
+
+    expected = from_historical_states(periods)
+    got = from_arrays(periods)
+    assert [(x["start"], x["sum"]) for x in expected] == [
+        (x["start"], x["sum"]) for x in got
+    ]
+
+    hist_states = historical_states_from_periods(periods)
+    cases = [
+        (
+            "groupby, prebuilt HistoricalState list",
+            lambda: groupby_statistic_data(hist_states),
+        ),
+        (
+            "epoch, periods to HistoricalState to arrays",
+            lambda: from_historical_states(periods),
+        ),
+        ("epoch, periods arrays (backfill)", lambda: from_arrays(periods)),
+    ]
+
+    print(f"{HOURS} hourly periods, mean of {NUMBER} runs")
+    for name, fn in cases:
+        elapsed = timeit.timeit(fn, number=NUMBER) / NUMBER
+        print(f"  {name:<46} {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,30 +17,41 @@
 
 
 import asyncio
+import hashlib
 import logging
-import math
 from datetime import timedelta
 
+import aiohttp
 import ideenergy
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import CONF_PASSWORD, CONF_USERNAME, Platform
+from homeassistant.const import Platform
 from homeassistant.core import HomeAssistant
 from homeassistant.exceptions import ConfigEntryNotReady
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers import device_registry as dr
 from homeassistant.helpers.entity import DeviceInfo
 
-from .barrier import TimeDeltaBarrier, TimeWindowBarrier  # NoopBarrier,
+from .api import async_get_client, async_release_client
+from .barrier import (  # NoopBarrier,
+    Barrier,
+    BarriersStore,
+    TimeDeltaBarrier,
+    TimeWindowBarrier,
+)
 from .const import (
-    API_USER_SESSION_TIMEOUT,
-    CONF_CONTRACT,
     DOMAIN,
+    HISTORICAL_UPDATE_TIMEOUT,
     MAX_RETRIES,
     MEASURE_MAX_AGE,
+    MEASURE_UPDATE_TIMEOUT,
     MIN_SCAN_INTERVAL,
     UPDATE_WINDOW_END_MINUTE,
+    UPDATE_WINDOW_SLOT_MINUTES,
+    UPDATE_WINDOW_SLOTS,
     UPDATE_WINDOW_START_MINUTE,
 )
 from .datacoordinator import DataSetType, IDeCoordinator
+from .maintenance import RecorderMaintenance
+from .ratelimit import RateLimitDeferredError
 from .updates import update_integration
 
 PLATFORMS: list[str] = [Platform.SENSOR]
@@ -49,58 +60,111 @@ _LOGGER = logging.getLogger(__name__)
 
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    api = IDeEnergyAPI(hass, entry)
+    api = await async_get_client(hass, entry)
 
+    # The shared client must be released whatever happens here
     try:
         contract_details = await api.get_contract_details()
+
+    except (
+        RateLimitDeferredError,
+        TimeoutError,
+        aiohttp.ClientError,
+        ideenergy.RequestFailedError,
+    ) as e:
+        # Transient, let Home Assistant retry setup later
+        async_release_client(hass, entry)
+        raise ConfigEntryNotReady(f"Unable to initialize integration: {e}") from e
+
     except ideenergy.client.ClientError as e:
         _LOGGER.debug(f"Unable to initialize integration: {e}")
+        async_release_client(hass, entry)
         return False
 
+    except BaseException:
+        async_release_client(hass, entry)
+        raise
+
     device_info = IDeEnergyDeviceInfo(contract_details)
+    window_offset = _async_get_update_window_offset(
+        hass, entry, contract_details["cups"]
+    )
 
-    coordinator = IDeCoordinator(
-        hass=hass,
-        api=api,
-        barriers={
-            DataSetType.MEASURE: TimeWindowBarrier(
-                allowed_window_minutes=(
-                    UPDATE_WINDOW_START_MINUTE,
-                    UPDATE_WINDOW_END_MINUTE,
-                ),
-                max_retries=MAX_RETRIES,
-                max_age=timedelta(seconds=MEASURE_MAX_AGE),
+    barriers: dict[DataSetType, Barrier] = {
+        DataSetType.MEASURE: TimeWindowBarrier(
+            allowed_window_minutes=(
+                UPDATE_WINDOW_START_MINUTE + window_offset,
+                UPDATE_WINDOW_END_MINUTE,
             ),
-            DataSetType.HISTORICAL_CONSUMPTION: TimeDeltaBarrier(
-                delta=timedelta(hours=6)
-            ),
-            DataSetType.HISTORICAL_GENERATION: TimeDeltaBarrier(
-                delta=timedelta(hours=6)
-            ),
-            DataSetType.HISTORICAL_POWER_DEMAND: TimeDeltaBarrier(
-                delta=timedelta(hours=36)
-            ),
-        },
-        # Use default update_interval and relay on barriers for now
-        # MEASURE barrier should deny if last attempt (success or not) is too recent to
-        # prevent api smashing or subsequent baning
-        update_interval=_calculate_datacoordinator_update_interval(),
-        # update_interval=timedelta(seconds=30),
-    )
+            max_retries=MAX_RETRIES,
+            max_age=timedelta(seconds=MEASURE_MAX_AGE),
+        ),
+        DataSetType.HISTORICAL_CONSUMPTION: TimeDeltaBarrier(delta=timedelta(hours=6)),
+        DataSetType.HISTORICAL_GENERATION: TimeDeltaBarrier(delta=timedelta(hours=6)),
+        DataSetType.HISTORICAL_POWER_DEMAND: TimeDeltaBarrier(
+            delta=timedelta(hours=36)
+        ),
+    }
+
+    # Restore barriers, a restart must not download again data that is still fresh
+    barriers_store = BarriersStore(hass, _build_barriers_store_key(entry), barriers)
+    await barriers_store.async_load()
+
+    timeouts = {
+        DataSetType.MEASURE: timedelta(seconds=MEASURE_UPDATE_TIMEOUT),
+        DataSetType.HISTORICAL_CONSUMPTION: timedelta(
+            seconds=HISTORICAL_UPDATE_TIMEOUT
+        ),
+        DataSetType.HISTORICAL_GENERATION: timedelta(seconds=HISTORICAL_UPDATE_TIMEOUT),
+        DataSetType.HISTORICAL_POWER_DEMAND: timedelta(
+            seconds=HISTORICAL_UPDATE_TIMEOUT
+        ),
+    }
+
+    # One coordinator per dataset, each one with its own update interval. API client,
+    # barriers store and recorder maintenance are shared
+    maintenance = RecorderMaintenance(hass)
+    coordinators = {
+        dataset: IDeCoordinator(
+            hass=hass,
+            api=api,
+            dataset=dataset,
+            barrier=barrier,
+            timeout=timeouts[dataset],
+            barriers_store=barriers_store,
+            maintenance=maintenance,
+            # Initial update_interval, after each update the coordinator reschedules
+            # itself at the point its barrier will allow an update.
+            # MEASURE barrier should deny if last attempt (success or not) is too
+            # recent to prevent api smashing or subsequent baning
+            update_interval=timedelta(seconds=MIN_SCAN_INTERVAL),
+        )
+        for dataset, barrier in barriers.items()
+    }
 
-    # Don't refresh coordinator yet since there isn't any sensor registered
+    # Don't refresh coordinators yet since there isn't any sensor registered
     # await coordinator.async_refresh()
 
-    if not coordinator.last_update_success:
+    if not all(x.last_update_success for x in coordinators.values()):
+        async_release_client(hass, entry)
         raise ConfigEntryNotReady
 
+    # FIXME: platforms from HomeAssistant should have types
+    platforms: list[str] = [
+        platform for platform in PLATFORMS if entry.options.get(platform, True)
+    ]
+
     hass.data[DOMAIN] = hass.data.get(DOMAIN, {})
-    hass.data[DOMAIN][entry.entry_id] = (coordinator, device_info)
+    hass.data[DOMAIN][entry.entry_id] = (coordinators, device_info, platforms)
 
-    for platform in PLATFORMS:
-        if entry.options.get(platform, True):
-            coordinator.platforms.append(platform)
-    await hass.config_entries.async_forward_entry_setups(entry,coordinator.platforms)
+    await hass.config_entries.async_forward_entry_setups(entry, platforms)
+
+    # All entities are registered at this point, run a single refresh for each
+    # dataset in the background
+    for coordinator in coordinators.values():
+        entry.async_create_background_task(
+            hass, coordinator.async_refresh(), name=f"{coordinator.name} first refresh"
+        )
 
     entry.async_on_unload(entry.add_update_listener(async_reload_entry))
 
@@ -108,48 +172,112 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
 
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    coordinator, _ = hass.data[DOMAIN][entry.entry_id]
+    coordinators, _, platforms = hass.data[DOMAIN][entry.entry_id]
     unloaded = all(
         await asyncio.gather(
             *[
                 hass.config_entries.async_forward_entry_unload(entry, platform)
                 for platform in PLATFORMS
-                if platform in coordinator.platforms
+                if platform in platforms
             ]
         )
     )
     if unloaded:
         hass.data[DOMAIN].pop(entry.entry_id)
 
+        # Stop in-flight refreshes and meter reads before releasing the client
+        for coordinator in coordinators.values():
+            await coordinator.async_shutdown()
+
+        # Maintenance and barriers store are shared by all coordinators
+        coordinator = next(iter(coordinators.values()))
+        coordinator.maintenance.async_cancel()
+        async_release_client(hass, entry)
+
+        # Flush barriers now, a reload will restore them right away
+        if coordinator.barriers_store is not None:
+            await coordinator.barriers_store.async_save()
+
     return unloaded
 
 
+async def async_remove_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    await BarriersStore(hass, _build_barriers_store_key(entry), {}).async_remove()
+
+
 async def async_reload_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
     await async_unload_entry(hass, entry)
     await async_setup_entry(hass, entry)
 
 
-def _calculate_datacoordinator_update_interval() -> timedelta:
-    #
-    # Calculate SCAN_INTERVAL to allow two updates within the update window
-    #
-    update_window_width = (
-        UPDATE_WINDOW_END_MINUTE * 60 - UPDATE_WINDOW_START_MINUTE * 60
+def _build_barriers_store_key(entry: ConfigEntry) -> str:
+    return f"{DOMAIN}.{entry.entry_id}.barriers"
+
+
+#
+# Measure update window is split in slots so contracts don't request their meters
+# at the same time. Slots are spaced by more than the measure timeout, reads of
+# different slots never overlap.
+#
+# The preferred slot is derived from the CUPS (stable across restarts and spread
+# across installations). Collisions between contracts of this installation are
+# solved in CUPS order, every entry computes the same allocation regardless of
+# setup order. CUPS of other entries are taken from their devices.
+#
+
+
+def _async_get_update_window_offset(
+    hass: HomeAssistant, entry: ConfigEntry, cups: str
+) -> int:
+    dev_reg = dr.async_get(hass)
+
+    all_cups = {cups}
+    for other in hass.config_entries.async_entries(DOMAIN):
+        if other.entry_id == entry.entry_id:
+            continue
+
+        for device in dr.async_entries_for_config_entry(dev_reg, other.entry_id):
+            all_cups.update(v for k, v in device.identifiers if k == "cups")
+
+    slots = _allocate_update_window_slots(sorted(all_cups))
+    offset = slots[cups] * UPDATE_WINDOW_SLOT_MINUTES
+    _LOGGER.debug(
+        f"{cups}: measure update window starts at minute "
+        + f"{UPDATE_WINDOW_START_MINUTE + offset}"
     )
-    update_interval = math.floor(update_window_width / 2)
-    update_interval = max([MIN_SCAN_INTERVAL, update_interval])
 
-    return timedelta(seconds=update_interval)
+    return offset
+
+
+def _allocate_update_window_slots(all_cups: list[str]) -> dict[str, int]:
+    slots: dict[str, int] = {}
+
+    for cups in all_cups:
+        preferred = int(hashlib.sha256(cups.encode("utf-8")).hexdigest(), 16)
+        taken = set(slots.values())
+        for idx in range(UPDATE_WINDOW_SLOTS):
+            slot = (preferred + idx) % UPDATE_WINDOW_SLOTS
+            if slot not in taken:
+                break
+        else:
+            # More contracts than slots, share the preferred one
+            slot = preferred % UPDATE_WINDOW_SLOTS
+
+        slots[cups] = slot
+
+    return slots
 
 
 async def async_migrate_entry(hass: HomeAssistant, entry: ConfigEntry):
-    api = IDeEnergyAPI(hass, entry)
+    api = await async_get_client(hass, entry)
 
     try:
         contract_details = await api.get_contract_details()
     except ideenergy.client.ClientError as e:
         _LOGGER.debug(f"Unable to initialize integration: {e}")
         return False
+    finally:
+        async_release_client(hass, entry)
 
     update_integration(hass, entry, IDeEnergyDeviceInfo(contract_details))
     return True
@@ -163,13 +291,3 @@ def IDeEnergyDeviceInfo(contract_details):
         name=contract_details["cups"],
         manufacturer=contract_details["listContador"][0]["tipMarca"],
     )
-
-
-def IDeEnergyAPI(hass: HomeAssistant, entry: ConfigEntry):
-    return ideenergy.Client(
-        session=async_get_clientsession(hass),
-        username=entry.data[CONF_USERNAME],
-        password=entry.data[CONF_PASSWORD],
-        contract=entry.data[CONF_CONTRACT],
-        user_session_timeout=API_USER_SESSION_TIMEOUT,
-    )
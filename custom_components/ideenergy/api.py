@@ -0,0 +1,423 @@
+# Copyright (C) 2021-2022 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+#
+# i-DE keeps the selected contract in the user session, so config entries for
+# different contracts of the same account can share a single logged client as long
+# as contract switches don't happen while there are requests in flight.
+#
+# User sessions (cookies) are stored and reused across updates and restarts. A
+# session not used recently is assumed to be still valid: if a request fails with it
+# the client logs in (and selects the contract) and the request is retried once.
+# Sessions are not kept alive, keepalive requests would cost more than the logins
+# they save.
+#
+
+
+import asyncio
+import contextlib
+import logging
+from collections.abc import AsyncIterator, Awaitable, Callable
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from typing import Any, TypeVar
+
+import aiohttp
+import ideenergy
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
+from homeassistant.core import HomeAssistant, callback, dt_util
+from homeassistant.helpers.aiohttp_client import async_create_clientsession
+from homeassistant.helpers.singleton import singleton
+from yarl import URL
+
+from .const import (
+    API_USER_SESSION_MAX_AGE,
+    API_USER_SESSION_TIMEOUT,
+    CONF_CONTRACT,
+    DOMAIN,
+    I_DE_URL,
+)
+from .ratelimit import Priority, RateLimiter, async_get_rate_limiter
+from .store import StoredDict
+
+_LOGGER = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+# Errors that may be caused by an expired user session
+_SESSION_ERRORS = (ideenergy.ClientError, ValueError)
+
+DATA_CLIENTS = f"{DOMAIN}_clients"
+DATA_USER_SESSIONS = f"{DOMAIN}_user_sessions"
+STORE_KEY = f"{DOMAIN}.user_sessions"
+
+
+@singleton(DATA_USER_SESSIONS)
+async def async_get_user_sessions(hass: HomeAssistant) -> StoredDict:
+    """Cookies and last use of the user session of each account"""
+
+    sessions = StoredDict(hass, STORE_KEY, private=True)
+    await sessions.async_load()
+    return sessions
+
+
+class SharedClient:
+    """ideenergy.Client shared by all config entries of the same account"""
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        session: aiohttp.ClientSession,
+        client: ideenergy.Client,
+        user_sessions: StoredDict,
+        rate_limiter: RateLimiter,
+    ):
+        self.hass = hass
+        self.session = session
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.entries: set[str] = set()
+
+        self._condition = asyncio.Condition()
+        self._in_flight = 0
+        self._switch_waiters = 0
+
+        self._user_sessions = user_sessions
+        self._last_used: datetime | None = None  # Any successful request
+
+    @property
+    def username(self) -> str:
+        return self.client.username
+
+    def restore_user_session(self) -> None:
+        if (stored := self._user_sessions.get(self.username)) is None:
+            return
+
+        try:
+            last_used = dt_util.parse_datetime(stored["last_used"])
+            cookies = stored["cookies"]
+        except (KeyError, TypeError, ValueError) as e:
+            _LOGGER.debug(f"{self.username}: invalid stored user session ({e!r})")
+            return
+
+        if last_used is None or dt_util.utcnow() - last_used > timedelta(
+            seconds=API_USER_SESSION_MAX_AGE
+        ):
+            _LOGGER.debug(f"{self.username}: stored user session is too old")
+            return
+
+        jar = SimpleCookie()
+        for cookie in cookies:
+            jar[cookie["name"]] = cookie["value"]
+            jar[cookie["name"]]["domain"] = cookie["domain"]
+            jar[cookie["name"]]["path"] = cookie["path"]
+
+        self.session.cookie_jar.update_cookies(jar, URL(I_DE_URL))
+        self._last_used = last_used
+        _LOGGER.debug(f"{self.username}: user session restored (used {last_used})")
+
+    async def _async_ensure_user_session(self) -> bool:
+        """Login if needed.
+
+        Returns True if a previous user session is reused without being verified.
+        """
+
+        if self.client.is_logged:
+            return False
+
+        # Cookies from a previous session may be still valid, assume they are instead
+        # of login and select the contract again. See async_use_contract
+        if self._last_used is not None and dt_util.utcnow() - self._last_used < (
+            timedelta(seconds=API_USER_SESSION_MAX_AGE)
+        ):
+            _LOGGER.debug(
+                f"{self.username}: reusing user session (used {self._last_used})"
+            )
+            self.client._login_ts = datetime.now()
+            return True
+
+        await self._async_login()
+        return False
+
+    async def _async_login(self) -> None:
+        # Login selects the current contract (if any) too
+        for _ in range(2 if self.client._contract else 1):
+            await self.rate_limiter.async_acquire(Priority.HIGH)
+
+        await self.client.login()
+        self._async_touch_user_session()
+
+    @callback
+    def _async_touch_user_session(self) -> None:
+        now = dt_util.utcnow()
+
+        # i-DE renews the user session on each request, ideenergy.Client only counts
+        # from login
+        self.client._login_ts = datetime.now()
+        self._last_used = now
+
+        self._user_sessions.set(
+            self.username,
+            {
+                "last_used": now.isoformat(),
+                "cookies": [
+                    {
+                        "name": x.key,
+                        "value": x.value,
+                        "domain": x["domain"],
+                        "path": x["path"],
+                    }
+                    for x in self.session.cookie_jar
+                ],
+            },
+        )
+
+    @callback
+    def _async_invalidate_user_session(self) -> None:
+        # Next request does a full login, stored cookies are not reused
+        self.client._login_ts = None
+        self._last_used = None
+
+    @callback
+    def async_shutdown(self) -> None:
+        # Session is owned by this client, not shared with HA, close it (cookies have
+        # been already saved in the user sessions store)
+        self.hass.async_create_task(self.session.close(), f"{self.username} close")
+
+    async def async_use_contract(
+        self,
+        contract: str,
+        fn: Callable[[], Awaitable[_T]],
+        *,
+        priority: Priority = Priority.HIGH,
+        cost: int = 1,
+    ) -> _T:
+        """Run fn (cost requests) with contract selected.
+
+        If fn fails using a reused, not verified, user session, it's retried once
+        after login.
+        """
+
+        for attempt in range(2):
+            for _ in range(cost):
+                await self.rate_limiter.async_acquire(priority)
+
+            async with self._async_contract_selected(contract) as unverified:
+                try:
+                    ret = await fn()
+
+                except _SESSION_ERRORS as e:
+                    # Maybe user session has expired, login on next request
+                    self._async_invalidate_user_session()
+                    if not unverified or attempt > 0:
+                        raise
+
+                    _LOGGER.debug(
+                        f"{self.username}: request failed with reused user session "
+                        + f"({e!r}), retrying after login"
+                    )
+                    continue
+
+                self._async_touch_user_session()
+                return ret
+
+        raise AssertionError("unreachable")
+
+    @contextlib.asynccontextmanager
+    async def _async_contract_selected(self, contract: str) -> AsyncIterator[bool]:
+        """Hold contract selected, yields if user session has not been verified.
+
+        Requests for the selected contract run concurrently, a switch to another
+        contract waits for all of them to finish. Requests for the selected contract
+        don't overtake pending switches.
+        """
+
+        async with self._condition:
+            if self.client._contract != contract:
+                self._switch_waiters = self._switch_waiters + 1
+                try:
+                    await self._condition.wait_for(lambda: self._in_flight == 0)
+                finally:
+                    self._switch_waiters = self._switch_waiters - 1
+
+            else:
+                await self._condition.wait_for(
+                    lambda: self._in_flight == 0
+                    or (self.client._contract == contract and self._switch_waiters == 0)
+                )
+
+            # Login and switch while holding the lock, nothing else can run meanwhile
+            unverified = await self._async_ensure_user_session()
+            if self.client._contract != contract:
+                unverified = await self._async_select_contract(contract, unverified)
+
+            self._in_flight = self._in_flight + 1
+
+        try:
+            yield unverified
+
+        finally:
+            async with self._condition:
+                self._in_flight = self._in_flight - 1
+                self._condition.notify_all()
+
+    async def _async_select_contract(self, contract: str, unverified: bool) -> bool:
+        _LOGGER.debug(f"{self.username}: switching to contract {contract}")
+
+        await self.rate_limiter.async_acquire(Priority.HIGH)
+        try:
+            await self.client.select_contract(contract)
+
+        except _SESSION_ERRORS:
+            self._async_invalidate_user_session()
+            if not unverified:
+                raise
+
+            # Reused user session has expired, login selects the contract too
+            self.client._contract = contract
+            await self._async_login()
+            return False
+
+        self._async_touch_user_session()
+        return unverified
+
+
+class ContractClient:
+    """Per-contract view of a SharedClient, same interface as ideenergy.Client"""
+
+    def __init__(self, shared: SharedClient, contract: str):
+        self._shared = shared
+        self.contract = contract
+
+    @property
+    def username(self) -> str:
+        return self._shared.username
+
+    @property
+    def is_logged(self) -> bool:
+        return self._shared.client.is_logged
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self._shared.rate_limiter
+
+    async def login(self) -> None:
+        # No request is done if a previous user session can be reused
+        async with self._shared._async_contract_selected(self.contract):
+            pass
+
+    async def get_contract_details(self) -> dict[str, Any]:
+        return await self._shared.async_use_contract(
+            self.contract, self._shared.client.get_contract_details
+        )
+
+    async def get_contracts(self) -> list[dict[str, Any]]:
+        return await self._shared.async_use_contract(
+            self.contract, self._shared.client.get_contracts
+        )
+
+    async def get_measure(self) -> ideenergy.Measure:
+        return await self._shared.async_use_contract(
+            self.contract, self._shared.client.get_measure
+        )
+
+    async def get_historical_consumption(
+        self, start: datetime, end: datetime
+    ) -> ideenergy.HistoricalConsumption:
+        return await self._shared.async_use_contract(
+            self.contract,
+            lambda: self._shared.client.get_historical_consumption(
+                start=start, end=end
+            ),
+            priority=Priority.LOW,
+        )
+
+    async def get_historical_generation(
+        self, start: datetime, end: datetime
+    ) -> ideenergy.HistoricalGeneration:
+        return await self._shared.async_use_contract(
+            self.contract,
+            lambda: self._shared.client.get_historical_generation(start=start, end=end),
+            priority=Priority.LOW,
+        )
+
+    async def get_historical_power_demand(self) -> ideenergy.HistoricalPowerDemand:
+        # Two requests: available interval and then the data itself
+        return await self._shared.async_use_contract(
+            self.contract,
+            self._shared.client.get_historical_power_demand,
+            priority=Priority.LOW,
+            cost=2,
+        )
+
+    def __repr__(self):
+        return f"<ContractClient {self.username}/{self.contract}>"
+
+
+async def async_get_client(hass: HomeAssistant, entry: ConfigEntry) -> ContractClient:
+    """Get (or create) the shared client for the entry's account"""
+
+    username = entry.data[CONF_USERNAME]
+    user_sessions = await async_get_user_sessions(hass)
+    rate_limiter = await async_get_rate_limiter(hass, username)
+
+    clients: dict[str, SharedClient] = hass.data.setdefault(DATA_CLIENTS, {})
+
+    if (shared := clients.get(username)) is None:
+        # Each account has its own cookie jar
+        session = async_create_clientsession(hass)
+        shared = SharedClient(
+            hass,
+            session,
+            ideenergy.Client(
+                session=session,
+                username=username,
+                password=entry.data[CONF_PASSWORD],
+                user_session_timeout=API_USER_SESSION_TIMEOUT,
+            ),
+            user_sessions,
+            rate_limiter,
+        )
+        shared.restore_user_session()
+        clients[username] = shared
+        _LOGGER.debug(f"{username}: client created")
+
+    elif shared.client.password != entry.data[CONF_PASSWORD]:
+        _LOGGER.warning(
+            f"{username}: config entries with different passwords, "
+            + "using the first one"
+        )
+
+    shared.entries.add(entry.entry_id)
+    return ContractClient(shared, entry.data[CONF_CONTRACT])
+
+
+@callback
+def async_release_client(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    clients: dict[str, SharedClient] = hass.data.get(DATA_CLIENTS, {})
+    username = entry.data[CONF_USERNAME]
+
+    if (shared := clients.get(username)) is None:
+        return
+
+    shared.entries.discard(entry.entry_id)
+    if not shared.entries:
+        shared.async_shutdown()
+        clients.pop(username)
+        _LOGGER.debug(f"{username}: client released")
@@ -0,0 +1,161 @@
+# Copyright (C) 2021-2022 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import logging
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from typing import Any
+
+import sqlalchemy as sa
+from homeassistant.components.recorder import db_schema
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.singleton import singleton
+from homeassistant_historical_sensor import recorderutil
+
+from .const import DOMAIN, MAINLAND_SPAIN_ZONEINFO
+from .store import StoredDict
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_CHECKPOINTS = f"{DOMAIN}_backfill_checkpoints"
+STORE_KEY = f"{DOMAIN}.backfill"
+
+
+@dataclass
+class BackfillCheckpoint:
+    start: date
+    end: date
+    next: date
+    pace: float
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "next": self.next.isoformat(),
+            "pace": self.pace,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "BackfillCheckpoint":
+        return cls(
+            start=date.fromisoformat(data["start"]),
+            end=date.fromisoformat(data["end"]),
+            next=date.fromisoformat(data["next"]),
+            pace=float(data["pace"]),
+        )
+
+
+class BackfillCheckpoints(StoredDict):
+    """Keeps track of the last chunk imported by each statistic"""
+
+    def get(self, statistic_id: str) -> BackfillCheckpoint | None:
+        if (data := super().get(statistic_id)) is None:
+            return None
+
+        try:
+            return BackfillCheckpoint.from_dict(data)
+        except (KeyError, TypeError, ValueError) as e:
+            _LOGGER.debug(f"{statistic_id}: invalid backfill checkpoint ({e!r})")
+            return None
+
+    async def async_set(
+        self, statistic_id: str, checkpoint: BackfillCheckpoint
+    ) -> None:
+        self.set(statistic_id, checkpoint.as_dict())
+        await self.async_save()
+
+    async def async_remove(self, statistic_id: str) -> None:
+        self.set(statistic_id, None)
+        await self.async_save()
+
+
+@singleton(DATA_CHECKPOINTS)
+async def async_get_backfill_checkpoints(hass: HomeAssistant) -> BackfillCheckpoints:
+    checkpoints = BackfillCheckpoints(hass, STORE_KEY)
+    await checkpoints.async_load()
+    return checkpoints
+
+
+def iter_month_chunks(start: date, end: date) -> Iterator[tuple[date, date]]:
+    """Split [start, end) into chunks not crossing month boundaries"""
+
+    while start < end:
+        if start.month == 12:
+            next_month = date(start.year + 1, 1, 1)
+        else:
+            next_month = date(start.year, start.month + 1, 1)
+
+        chunk_end = min(next_month, end)
+        yield start, chunk_end
+        start = chunk_end
+
+
+def local_date_as_timestamp(d: date) -> float:
+    return datetime.combine(d, time.min, tzinfo=MAINLAND_SPAIN_ZONEINFO).timestamp()
+
+
+def get_statistic_before(
+    hass: HomeAssistant, statistic_id: str, timestamp: float
+) -> dict[str, Any] | None:
+    """Last statistic (start and sum) strictly before timestamp"""
+
+    with recorderutil.hass_recorder_session(hass) as session:
+        row = session.execute(
+            sa.select(db_schema.Statistics.start_ts, db_schema.Statistics.sum)
+            .join(
+                db_schema.StatisticsMeta,
+                db_schema.Statistics.metadata_id == db_schema.StatisticsMeta.id,
+            )
+            .where(db_schema.StatisticsMeta.statistic_id == statistic_id)
+            .where(db_schema.Statistics.start_ts < timestamp)
+            .order_by(db_schema.Statistics.start_ts.desc())
+            .limit(1)
+        ).first()
+
+    if row is None:
+        return None
+
+    return {"start": row.start_ts, "sum": row.sum}
+
+
+def shift_statistics_sum(
+    hass: HomeAssistant, statistic_id: str, since_timestamp: float, delta: float
+) -> int:
+    """Add delta to the sum of every statistic since timestamp"""
+
+    with recorderutil.hass_recorder_session(hass) as session:
+        metadata_id = session.execute(
+            sa.select(db_schema.StatisticsMeta.id).where(
+                db_schema.StatisticsMeta.statistic_id == statistic_id
+            )
+        ).scalar()
+        if metadata_id is None:
+            return 0
+
+        res = session.execute(
+            sa.update(db_schema.Statistics)
+            .where(db_schema.Statistics.metadata_id == metadata_id)
+            .where(db_schema.Statistics.start_ts >= since_timestamp)
+            .values(sum=db_schema.Statistics.sum + delta)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+
+    return res.rowcount
@@ -19,11 +19,13 @@
 import enum
 import functools
 import logging
+import random
 from abc import abstractmethod
 from datetime import datetime, timedelta, timezone
 from typing import Any
 
-from homeassistant.core import dt_util
+from homeassistant.core import HomeAssistant, dt_util
+from homeassistant.helpers.storage import Store
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -37,9 +39,14 @@ ATTR_FORCED = "forced"
 ATTR_LAST_SUCCESS = "last_success"
 ATTR_STATE = "state"
 ATTR_RETRY = "retry"
+ATTR_RETRY_AT = "retry_at"
 ATTR_ALLOWED_WINDOW_MINUTES = "allowed_window_minutes"
 
 DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE = timedelta(seconds=60)
+
+STORE_VERSION = 1
+STORE_SAVE_DELAY = 10
 
 
 def check_tzinfo(
@@ -97,10 +104,22 @@ class Barrier:
     def fail(self, **kwargs: Any) -> None:
         raise NotImplementedError()
 
+    @abstractmethod
+    def next_allowed_at(self, **kwargs: Any) -> datetime:
+        """Earliest point in time when check() is expected to allow an update"""
+        raise NotImplementedError()
+
     @abstractmethod
     def dump(self) -> dict[str, Any]:
         return {}
 
+    def dump_state(self) -> dict[str, Any]:
+        """JSON serializable internal state, used to persist barriers"""
+        return {}
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        pass
+
 
 class BarrierException(Exception):
     pass
@@ -118,14 +137,30 @@ class TimeDeltaBarrier(Barrier):
         self,
         delta: timedelta,
         last_success: datetime | None = None,
+        backoff_base: timedelta = DEFAULT_BACKOFF_BASE,
+        backoff_max: timedelta | None = None,
     ):
         self._delta = delta
         self._last_success = last_success or dt_util.utc_from_timestamp(0)
 
+        # Failed updates are retried with exponential backoff, never waiting more
+        # than delta by default
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max or delta
+        self._failures = 0
+        self._retry_at = dt_util.utc_from_timestamp(0)
+
     @check_tzinfo("now", optional=True)
     def check(self, now: datetime | None = None) -> None:
         now = now or self.utcnow()
 
+        if now < self._retry_at:
+            retry_at = dt_util.as_local(self._retry_at)
+            raise BarrierDeniedError(
+                code=TimeDeltaBarrierDenyError.BACKOFF,
+                reason=f"backing off after {self._failures} failures until {retry_at}",
+            )
+
         diff = now - self._last_success
         if diff < self._delta:
             raise BarrierDeniedError(
@@ -137,10 +172,27 @@ class TimeDeltaBarrier(Barrier):
     def success(self, now: datetime | None = None) -> None:
         now = now or self.utcnow()
         self._last_success = now
+        self._failures = 0
+        self._retry_at = dt_util.utc_from_timestamp(0)
 
     @check_tzinfo("now", optional=True)
     def fail(self, now: datetime | None = None) -> None:
-        pass
+        now = now or self.utcnow()
+
+        self._failures = self._failures + 1
+        self._retry_at = now + backoff_delay(
+            self._failures, self._backoff_base, self._backoff_max
+        )
+        _LOGGER.debug(
+            f"fail registered ({self._failures}), "
+            + f"retry at {dt_util.as_local(self._retry_at)}"
+        )
+
+    @check_tzinfo("now", optional=True)
+    def next_allowed_at(self, now: datetime | None = None) -> datetime:
+        now = now or self.utcnow()
+
+        return max(now, self._last_success + self._delta, self._retry_at)
 
     def utcnow(self) -> datetime:
         return dt_util.utcnow()
@@ -154,11 +206,29 @@ class TimeDeltaBarrier(Barrier):
         return self._last_success
 
     def dump(self) -> dict[str, Any]:
-        return {ATTR_MAX_AGE: self.delta, ATTR_LAST_SUCCESS: self.last_success}
+        return {
+            ATTR_MAX_AGE: self.delta,
+            ATTR_LAST_SUCCESS: self.last_success,
+            ATTR_RETRY: self._failures,
+            ATTR_RETRY_AT: self._retry_at,
+        }
+
+    def dump_state(self) -> dict[str, Any]:
+        return {
+            ATTR_LAST_SUCCESS: self._last_success.isoformat(),
+            ATTR_RETRY: self._failures,
+            ATTR_RETRY_AT: self._retry_at.isoformat(),
+        }
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        self._last_success = _parse_state_datetime(state, ATTR_LAST_SUCCESS)
+        self._failures = int(state.get(ATTR_RETRY, 0))
+        self._retry_at = _parse_state_datetime(state, ATTR_RETRY_AT)
 
 
 class TimeDeltaBarrierDenyError(enum.Enum):
     NO_MAX_AGE = enum.auto()
+    BACKOFF = enum.auto()
 
 
 class RetryableBarrier:
@@ -180,11 +250,19 @@ class TimeWindowBarrier(Barrier):
         allowed_window_minutes: tuple[int, int],
         max_retries: int,
         max_age: timedelta,
+        backoff_base: timedelta = DEFAULT_BACKOFF_BASE,
     ):
         self._max_age = max_age
         self._allowed_window_minutes = allowed_window_minutes
         self._max_retries = max_retries
 
+        # Retries are spaced with exponential backoff, never waiting more than the
+        # update window length
+        self._backoff_base = backoff_base
+        self._backoff_max = timedelta(
+            minutes=allowed_window_minutes[1] - allowed_window_minutes[0]
+        )
+
         zero_dt = dt_util.utc_from_timestamp(0)
 
         # state
@@ -192,6 +270,7 @@ class TimeWindowBarrier(Barrier):
         self._failures = 0
         self._last_success = zero_dt
         self._cooldown = zero_dt
+        self._retry_at = zero_dt
 
     def utcnow(self) -> datetime:
         return dt_util.utcnow()
@@ -207,10 +286,27 @@ class TimeWindowBarrier(Barrier):
             ATTR_FORCED: self._force_next,
             ATTR_LAST_SUCCESS: self._last_success,
             ATTR_RETRY: self._failures,
+            ATTR_RETRY_AT: self._retry_at,
         }
 
         return ret
 
+    def dump_state(self) -> dict[str, Any]:
+        return {
+            ATTR_COOLDOWN: self._cooldown.isoformat(),
+            ATTR_FORCED: self._force_next,
+            ATTR_LAST_SUCCESS: self._last_success.isoformat(),
+            ATTR_RETRY: self._failures,
+            ATTR_RETRY_AT: self._retry_at.isoformat(),
+        }
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        self._cooldown = _parse_state_datetime(state, ATTR_COOLDOWN)
+        self._force_next = bool(state.get(ATTR_FORCED, False))
+        self._last_success = _parse_state_datetime(state, ATTR_LAST_SUCCESS)
+        self._failures = int(state.get(ATTR_RETRY, 0))
+        self._retry_at = _parse_state_datetime(state, ATTR_RETRY_AT)
+
     @check_tzinfo("now", optional=True)
     def check(self, now: datetime | None = None) -> None:
         """
@@ -229,9 +325,7 @@ class TimeWindowBarrier(Barrier):
             <= self._allowed_window_minutes[1]
         )
         last_success_age = (now - self._last_success).total_seconds()
-        min_age = (
-            self._allowed_window_minutes[1] - self._allowed_window_minutes[0]
-        ) * 60
+        min_age = self._min_success_age()
 
         # Check if cooldown has been reached
         if self._failures >= self._max_retries and now >= self._cooldown:
@@ -250,6 +344,13 @@ class TimeWindowBarrier(Barrier):
             )
 
         if self._failures > 0 and self._failures < self._max_retries:
+            if now < self._retry_at:
+                retry_at = dt_util.as_local(self._retry_at)
+                raise BarrierDeniedError(
+                    code=TimeWindowBarrierDenyError.BACKOFF,
+                    reason=f"barrier is in retrying state, backing off until {retry_at}",
+                )
+
             _LOGGER.debug("barrier is in retrying state")
             return
 
@@ -268,6 +369,54 @@ class TimeWindowBarrier(Barrier):
                 code=TimeWindowBarrierDenyError.NO_DELTA, reason=reason
             )
 
+    @check_tzinfo("now", optional=True)
+    def next_allowed_at(self, now: datetime | None = None) -> datetime:
+        """
+        Follows the same order as check()
+        """
+        now = now or self.utcnow()
+
+        if self._force_next:
+            return now
+
+        if now < self._cooldown:
+            # Failures are reset once cooldown is reached
+            candidate = self._cooldown
+
+        elif self._failures > 0 and self._failures < self._max_retries:
+            return max(now, self._retry_at)
+
+        else:
+            candidate = now
+
+        # Next second after min_age has been reached
+        min_age = self._min_success_age()
+        candidate = max(candidate, self._last_success + timedelta(seconds=min_age + 1))
+
+        # Move candidate to the next opening of the update window if needed
+        local_candidate = dt_util.as_local(candidate)
+        if (
+            self._allowed_window_minutes[0]
+            <= local_candidate.minute
+            <= self._allowed_window_minutes[1]
+        ):
+            return candidate
+
+        window_start = local_candidate.replace(
+            minute=self._allowed_window_minutes[0], second=0, microsecond=0
+        )
+        if window_start <= local_candidate:
+            window_start = window_start + timedelta(hours=1)
+
+        return dt_util.as_utc(window_start)
+
+    def _min_success_age(self) -> int:
+        # A whole window (both ends included) must pass between successes, only one
+        # update per window
+        return (
+            self._allowed_window_minutes[1] - self._allowed_window_minutes[0] + 1
+        ) * 60
+
     def force_next(self) -> None:
         self._force_next = True
 
@@ -278,6 +427,7 @@ class TimeWindowBarrier(Barrier):
         self._force_next = False
         self._failures = 0
         self._last_success = now
+        self._retry_at = dt_util.utc_from_timestamp(0)
 
         _LOGGER.debug("success registered")
 
@@ -286,7 +436,13 @@ class TimeWindowBarrier(Barrier):
         now = now or self.utcnow()
 
         self._failures = self._failures + 1
-        _LOGGER.debug(f"fail registered ({self._failures}/{self._max_retries})")
+        self._retry_at = now + backoff_delay(
+            self._failures, self._backoff_base, self._backoff_max
+        )
+        _LOGGER.debug(
+            f"fail registered ({self._failures}/{self._max_retries}), "
+            + f"retry at {dt_util.as_local(self._retry_at)}"
+        )
 
         if self._failures >= self._max_retries:
             self._force_next = False
@@ -302,6 +458,7 @@ class TimeWindowBarrierDenyError(enum.Enum):
     UPDATE_WINDOW_CLOSED = enum.auto()
     COOLDOWN = enum.auto()
     NO_DELTA = enum.auto()
+    BACKOFF = enum.auto()
 
 
 class NoopBarrier(Barrier):
@@ -314,5 +471,69 @@ class NoopBarrier(Barrier):
     def fail(self):
         pass
 
+    def next_allowed_at(self, **kwargs) -> datetime:
+        return dt_util.utcnow()
+
     def dump(self) -> dict[str, Any]:
         return {}
+
+
+class BarriersStore:
+    """Persists the state of a set of barriers into a Home Assistant Store"""
+
+    def __init__(self, hass: HomeAssistant, key: str, barriers: dict[Any, Barrier]):
+        self._store: Store[dict[str, dict[str, Any]]] = Store(hass, STORE_VERSION, key)
+        self._barriers = barriers
+
+    async def async_load(self) -> None:
+        data = await self._store.async_load() or {}
+
+        for key, barrier in self._barriers.items():
+            name = getattr(key, "name", str(key))
+            if name not in data:
+                continue
+
+            try:
+                barrier.load_state(data[name])
+            except (KeyError, TypeError, ValueError) as e:
+                _LOGGER.debug(f"unable to restore barrier {name}: {e!r}")
+                continue
+
+            _LOGGER.debug(f"restored barrier {name}: {barrier.dump()}")
+
+    def async_schedule_save(self) -> None:
+        self._store.async_delay_save(self._data_to_save, STORE_SAVE_DELAY)
+
+    async def async_save(self) -> None:
+        await self._store.async_save(self._data_to_save())
+
+    async def async_remove(self) -> None:
+        await self._store.async_remove()
+
+    def _data_to_save(self) -> dict[str, dict[str, Any]]:
+        return {
+            getattr(key, "name", str(key)): barrier.dump_state()
+            for key, barrier in self._barriers.items()
+        }
+
+
+def backoff_delay(failures: int, base: timedelta, max_delay: timedelta) -> timedelta:
+    """Exponential backoff with jitter.
+
+    Delay doubles with each failure (up to max_delay) and it's randomized between
+    half and the full value, so retries from several instances don't synchronize.
+    """
+
+    delay = min(base * (2 ** max(failures - 1, 0)), max_delay)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _parse_state_datetime(state: dict[str, Any], key: str) -> datetime:
+    if (value := state.get(key)) is None:
+        return dt_util.utc_from_timestamp(0)
+
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        raise ValueError(f"{key} lacks tzinfo")
+
+    return dt_util.as_utc(dt)
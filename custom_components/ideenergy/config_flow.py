@@ -29,7 +29,14 @@ from homeassistant.data_entry_flow import FlowResult
 from homeassistant.helpers.aiohttp_client import async_create_clientsession
 
 from . import _LOGGER
-from .const import CONF_CONTRACT, CONFIG_ENTRY_VERSION, DOMAIN
+from .const import (
+    CONF_CONTRACT,
+    CONF_STATISTICS_ONLY,
+    CONFIG_ENTRY_VERSION,
+    DEFAULT_STATISTICS_ONLY,
+    DOMAIN,
+)
+from .ratelimit import Priority, RateLimitDeferredError, async_get_rate_limiter
 
 AUTH_SCHEMA = vol.Schema(
     {
@@ -47,10 +54,10 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):  # type: ignore[call
         self.info = {}
         self.api = None
 
-    # @staticmethod
-    # @callback
-    # def async_get_options_flow(config_entry):
-    #     return OptionsFlowHandler(config_entry)
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        return OptionsFlowHandler()
 
     async def async_step_user(
         self, user_input: dict[str, Any] | None = None
@@ -74,6 +81,9 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):  # type: ignore[call
             except ideenergy.ClientError:
                 errors["base"] = "invalid_auth"
 
+            except RateLimitDeferredError:
+                errors["base"] = "rate_limited"
+
             except Exception:  # pylint: disable=broad-except
                 _LOGGER.exception("Unexpected exception")
                 errors["base"] = "unknown"
@@ -96,6 +106,18 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):  # type: ignore[call
     async def async_step_contract(
         self, user_input: dict[str, Any] | None = None
     ) -> FlowResult:
+        rate_limiter = await async_get_rate_limiter(self.hass, self.api.username)
+        try:
+            # User session may have expired while the form was shown, login
+            # explicitly so that request is counted too
+            if not self.api.is_logged:
+                await rate_limiter.async_acquire(Priority.HIGH)
+                await self.api.login()
+
+            await rate_limiter.async_acquire(Priority.HIGH)
+        except RateLimitDeferredError:
+            return self.async_abort(reason="rate_limited")
+
         contracts = await self.api.get_contracts()
         contracts = {f"{x['cups']} ({x['direccion']})": x for x in contracts}
 
@@ -115,21 +137,35 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):  # type: ignore[call
         return self.async_create_entry(title=title, data=self.info)
 
 
-# class OptionsFlowHandler(config_entries.OptionsFlow):
-#     def __init__(self, config_entry):
-#         """Initialize options flow."""
-#         self.config_entry = config_entry
-#
-#     async def async_step_init(self, user_input=None):
-#         if user_input is not None:
-#             return self.async_create_entry(title="", data=user_input)
-#
-#         OPTIONS_SCHEMA = vol.Schema({})
-#
-#         return self.async_show_form(step_id="init", data_schema=OPTIONS_SCHEMA)
+class OptionsFlowHandler(config_entries.OptionsFlow):
+    async def async_step_init(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        if user_input is not None:
+            # Keep other options (enabled platforms) untouched
+            return self.async_create_entry(
+                title="", data=dict(self.config_entry.options) | user_input
+            )
+
+        OPTIONS_SCHEMA = vol.Schema(
+            {
+                vol.Optional(
+                    CONF_STATISTICS_ONLY,
+                    default=self.config_entry.options.get(
+                        CONF_STATISTICS_ONLY, DEFAULT_STATISTICS_ONLY
+                    ),
+                ): bool,
+            }
+        )
+
+        return self.async_show_form(step_id="init", data_schema=OPTIONS_SCHEMA)
 
 
 async def create_api(hass, username, password):
+    # Account requests from config flows count too
+    rate_limiter = await async_get_rate_limiter(hass, username)
+    await rate_limiter.async_acquire(Priority.HIGH)
+
     sess = async_create_clientsession(hass)
     client = ideenergy.Client(sess, username, password)
 
@@ -17,17 +17,33 @@
 
 
 from datetime import timedelta
+from zoneinfo import ZoneInfo
 
 DOMAIN = "ideenergy"
+I_DE_URL = "https://www.i-de.es/"
 
 CONF_CONTRACT = "contract"
+CONF_STATISTICS_ONLY = "statistics_only"
+
+DEFAULT_STATISTICS_ONLY = False
+
+# FIXME: What about canary islands?
+MAINLAND_SPAIN_ZONEINFO = ZoneInfo("Europe/Madrid")
 
 MEASURE_MAX_AGE = 60 * 50  # Fifty minutes
 MAX_RETRIES = 3
 MIN_SCAN_INTERVAL = 60
 UPDATE_WINDOW_START_MINUTE = 50
 UPDATE_WINDOW_END_MINUTE = 59
-API_USER_SESSION_TIMEOUT = 60
+UPDATE_WINDOW_SLOTS = 3  # Staggered window starts (minutes 50, 52 and 54)
+UPDATE_WINDOW_SLOT_MINUTES = 2  # Must be longer than MEASURE_UPDATE_TIMEOUT
+API_USER_SESSION_TIMEOUT = 60 * 10  # Since last successful request
+API_USER_SESSION_MAX_AGE = 60 * 60 * 6  # Stored sessions older than this are ignored
+API_RATE_LIMIT_PER_MINUTE = 10
+API_RATE_LIMIT_PER_DAY = 500
+API_RATE_LIMIT_LOW_PRIORITY_RESERVE = 100  # Daily requests kept for live measures
+MEASURE_UPDATE_TIMEOUT = 90  # ICP readings can take up to a minute
+HISTORICAL_UPDATE_TIMEOUT = 60
 
 
 DATA_ATTR_MEASURE_ACCUMULATED = "measure_accumulated"
@@ -37,4 +53,8 @@ DATA_ATTR_HISTORICAL_GENERATION = "historical_generation"
 DATA_ATTR_HISTORICAL_POWER_DEMAND = "historical_power_demand"
 
 HISTORICAL_PERIOD_LENGHT = timedelta(days=7)
+BACKFILL_DEFAULT_PACE = 30  # Seconds between backfill requests
+SERVICE_BACKFILL = "backfill"
+
+HISTORICAL_PERIOD_OVERLAP = timedelta(days=1)  # Allow late corrections from i-DE
 CONFIG_ENTRY_VERSION = 3
@@ -16,16 +16,18 @@
 # USA.
 
 
+import asyncio
 import enum
 import logging
-from datetime import datetime, timedelta, timezone
+from collections import Counter
+from datetime import date, datetime, time, timedelta, timezone
 from typing import Any, TypedDict
 
 import ideenergy
-from homeassistant.core import dt_util
+from homeassistant.core import callback, dt_util
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
 
-from .barrier import Barrier, BarrierDeniedError
+from .barrier import Barrier, BarrierDeniedError, BarriersStore
 from .const import (
     DATA_ATTR_HISTORICAL_CONSUMPTION,
     DATA_ATTR_HISTORICAL_GENERATION,
@@ -33,8 +35,13 @@ from .const import (
     DATA_ATTR_MEASURE_ACCUMULATED,
     DATA_ATTR_MEASURE_INSTANT,
     HISTORICAL_PERIOD_LENGHT,
+    HISTORICAL_PERIOD_OVERLAP,
+    MIN_SCAN_INTERVAL,
 )
 from .entity import IDeEntity
+from .historicaldata import HistoricalDemands, HistoricalPeriods
+from .maintenance import RecorderMaintenance
+from .ratelimit import RateLimitDeferredError
 
 
 class DataSetType(enum.IntFlag):
@@ -49,6 +56,16 @@ class DataSetType(enum.IntFlag):
 
 _LOGGER = logging.getLogger(__name__)
 
+_DATASET_DATA_ATTRS = {
+    DataSetType.MEASURE: (DATA_ATTR_MEASURE_ACCUMULATED, DATA_ATTR_MEASURE_INSTANT),
+    DataSetType.HISTORICAL_CONSUMPTION: (DATA_ATTR_HISTORICAL_CONSUMPTION,),
+    DataSetType.HISTORICAL_GENERATION: (DATA_ATTR_HISTORICAL_GENERATION,),
+    DataSetType.HISTORICAL_POWER_DEMAND: (DATA_ATTR_HISTORICAL_POWER_DEMAND,),
+}
+
+# Single datasets, ALL and NONE excluded
+_DATASETS = tuple(_DATASET_DATA_ATTRS)
+
 # _DEFAULT_COORDINATOR_DATA: dict[str, Any] = {
 #     DATA_ATTR_MEASURE_ACCUMULATED: None,
 #     DATA_ATTR_MEASURE_INSTANT: None,
@@ -69,42 +86,82 @@ _LOGGER = logging.getLogger(__name__)
 class CoordinatorData(TypedDict):
     DATA_ATTR_MEASURE_ACCUMULATED: int | None
     DATA_ATTR_MEASURE_INSTANT: float | None
-    DATA_ATTR_HISTORICAL_CONSUMPTION: ideenergy.HistoricalConsumption | None
-    DATA_ATTR_HISTORICAL_GENERATION: ideenergy.HistoricalGeneration | None
-    DATA_ATTR_HISTORICAL_POWER_DEMAND: ideenergy.HistoricalPowerDemand | None
+    DATA_ATTR_HISTORICAL_CONSUMPTION: HistoricalPeriods | None
+    DATA_ATTR_HISTORICAL_GENERATION: HistoricalPeriods | None
+    DATA_ATTR_HISTORICAL_POWER_DEMAND: HistoricalDemands | None
 
 
 class IDeCoordinator(DataUpdateCoordinator):
+    """Coordinator for a single dataset.
+
+    Each dataset of a contract has its own coordinator (and its own update
+    interval, refresh and listeners). API client, barriers store and recorder
+    maintenance are shared between them.
+    """
+
     def __init__(
         self,
         hass,
         api,
-        barriers: dict[DataSetType, Barrier],
+        dataset: DataSetType,
+        barrier: Barrier,
+        timeout: timedelta | None = None,
+        barriers_store: BarriersStore | None = None,
+        maintenance: RecorderMaintenance | None = None,
         update_interval: timedelta = timedelta(seconds=30),
     ):
+        if dataset not in _DATASETS:
+            raise ValueError(f"{dataset!r} is not a single dataset")
+
         name = (
-            f"{api.username}/{api._contract} coordinator" if api else "i-de coordinator"
+            f"{api.username}/{api.contract} {dataset.name.lower()} coordinator"
+            if api
+            else f"i-de {dataset.name.lower()} coordinator"
         )
         super().__init__(hass, _LOGGER, name=name, update_interval=update_interval)
         self.data: CoordinatorData = {  # type: ignore[assignment]
-            k: None
-            for k in [
-                DATA_ATTR_MEASURE_ACCUMULATED,
-                DATA_ATTR_MEASURE_INSTANT,
-                DATA_ATTR_HISTORICAL_CONSUMPTION,
-                DATA_ATTR_HISTORICAL_GENERATION,
-                DATA_ATTR_HISTORICAL_POWER_DEMAND,
-            ]
+            k: None for k in _DATASET_DATA_ATTRS[dataset]
         }
 
         self.api = api
-        self.barriers = barriers
-
-        # FIXME: platforms from HomeAssistant should have types
-        self.platforms: list[str] = []
+        self.dataset = dataset
+        self.barrier = barrier
+        self.timeout = timeout
+        self.barriers_store = barriers_store
+        self.maintenance = maintenance or RecorderMaintenance(hass)
 
         self.sensors: list[IDeEntity] = []
 
+        # Number of registered sensors interested in each dataset, kept up to date
+        # by register_sensor/unregister_sensor
+        self._datasets_refcount: Counter[DataSetType] = Counter()
+        self.requested_datasets = DataSetType.NONE
+
+        # Datasets updated in the last cycle, used to notify only interested entities
+        self.updated_datasets = DataSetType.NONE
+        self._last_notified_success = True
+
+        # Fingerprints of the last data received for each dataset
+        self._fingerprints: dict[DataSetType, int] = {}
+
+        # In-flight refresh, shared by concurrent refresh requests
+        self._refresh_task: asyncio.Task | None = None
+
+        # In-flight meter read, runs in background (see _async_update_data_raw)
+        self._read_task: asyncio.Task | None = None
+
+    async def _async_refresh(self, *args, **kwargs) -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = self.hass.async_create_task(
+                super()._async_refresh(*args, **kwargs),
+                f"{self.name} refresh",
+            )
+        else:
+            _LOGGER.debug("Refresh already in progress, waiting for it")
+
+        # Waiters can be cancelled without cancelling the refresh itself
+        await asyncio.shield(self._refresh_task)
+
     async def _async_update_data(self):
         """Fetch data from API endpoint.
 
@@ -122,112 +179,232 @@ class IDeCoordinator(DataUpdateCoordinator):
 
         # Raise UpdateFailed is something were wrong
 
-        ds = DataSetType.NONE
-        for sensor in self.sensors:
-            for s_ds in sensor.I_DE_DATA_SETS:
-                ds = ds | s_ds
+        # Recorder must be fixed before entities write new data
+        await self.maintenance.async_run()
 
-        dsstr = ds.name.replace("|", ", ")
-        _LOGGER.debug(f"Request update for datasets: {dsstr}")
+        updated_data = await self._async_update_data_raw()
+        self.updated_datasets = self.dataset if updated_data else DataSetType.NONE
+        if self.barriers_store is not None:
+            self.barriers_store.async_schedule_save()
 
-        updated_data = await self._async_update_data_raw(datasets=ds)
+        # Wake up again when the barrier is expected to allow an update
+        self.update_interval = self._calculate_update_interval()
 
         data = self.data | updated_data
         return data
 
+    @callback
+    def async_update_listeners(self) -> None:
+        # Availability changed, every entity must be notified
+        if self.last_update_success != self._last_notified_success:
+            self._last_notified_success = self.last_update_success
+            super().async_update_listeners()
+            return
+
+        if not self.last_update_success:
+            super().async_update_listeners()
+            return
+
+        for update_callback, context in list(self._listeners.values()):
+            if context is None or context & self.updated_datasets:
+                update_callback()
+
+    def _calculate_update_interval(
+        self, now: datetime | None = None
+    ) -> timedelta | None:
+        # Nobody is interested in this dataset, don't schedule any update
+        if not self.requested_datasets:
+            _LOGGER.debug(f"{self.dataset.name} not requested, updates stopped")
+            return None
+
+        now = now or dt_util.utcnow()
+        min_interval = timedelta(seconds=MIN_SCAN_INTERVAL)
+
+        interval = max(self.barrier.next_allowed_at() - now, min_interval)
+        _LOGGER.debug(f"Next update at {dt_util.as_local(now + interval)}")
+
+        return interval
+
     async def _async_update_data_raw(
-        self, datasets: DataSetType = DataSetType.ALL, now: datetime | None = None
+        self, now: datetime | None = None
     ) -> dict[str, Any]:
         now = now or dt_util.utcnow()
         if now.tzinfo != timezone.utc:
             raise ValueError("now is missing tzinfo field")
 
-        requested = (x for x in DataSetType)
-        requested = (x for x in requested if x is not DataSetType.ALL)
-        requested = (x for x in requested if x & datasets)
-        requested = list(requested)  # type: ignore[assignment]
+        if not self.requested_datasets:
+            _LOGGER.debug(f"update ignored for {self.dataset.name}: not requested")
+            return {}
 
-        data = {}
+        if self._read_task is not None and not self._read_task.done():
+            _LOGGER.debug(f"update ignored for {self.dataset.name}: read in progress")
+            return {}
 
-        for dataset in requested:
-            # Barrier checks and handle exceptions
-            try:
-                self.barriers[dataset].check()
+        if not self._check_barrier(self.dataset):
+            return {}
 
-            except KeyError:
-                _LOGGER.debug(f"update ignored for {dataset.name}: no barrier defined")
-                continue
+        # Meter reads can take up to a minute, they run in background and push their
+        # data when done. Update cycle returns right away
+        if self.dataset is DataSetType.MEASURE:
+            self._read_task = self.hass.async_create_background_task(
+                self._async_background_read(), f"{self.name} meter read"
+            )
+            return {}
 
-            except BarrierDeniedError as deny:
-                _LOGGER.debug(f"update denied for {dataset.name}: {deny.reason}")
-                continue
+        data = await self._async_update_dataset(self.dataset)
 
-            _LOGGER.debug(f"update allowed for {dataset.name}")
+        # delay = random.randint(DELAY_MIN_SECONDS * 10, DELAY_MAX_SECONDS * 10) / 10
+        # _LOGGER.debug(f"  → Random delay: {delay} seconds")
+        # await asyncio.sleep(delay)
+
+        return data
 
-            # API calls and handle exceptions
-            try:
+    async def _async_background_read(self) -> None:
+        data = await self._async_update_dataset(self.dataset)
+        if self.barriers_store is not None:
+            self.barriers_store.async_schedule_save()
+
+        if not data:
+            return
+
+        self.update_internal_data(data)
+        self.updated_datasets = self.dataset
+        self.async_update_listeners()
+
+    async def async_shutdown(self) -> None:
+        # Stop in-flight refresh and meter read and wait for them, they must not
+        # touch barriers (or the released API client) after shutdown
+        pending = [
+            x
+            for x in (self._refresh_task, self._read_task)
+            if x is not None and not x.done()
+        ]
+        for task in pending:
+            task.cancel()
+
+        if pending:
+            await asyncio.wait(pending)
+
+        await super().async_shutdown()
+
+    def _check_barrier(self, dataset: DataSetType) -> bool:
+        # Barrier checks and handle exceptions
+        try:
+            self.barrier.check()
+
+        except BarrierDeniedError as deny:
+            _LOGGER.debug(f"update denied for {dataset.name}: {deny.reason}")
+            return False
+
+        _LOGGER.debug(f"update allowed for {dataset.name}")
+        return True
+
+    async def _async_update_dataset(self, dataset: DataSetType) -> dict[str, Any]:
+        timeout = self.timeout
+
+        # API calls and handle exceptions
+        try:
+            async with asyncio.timeout(
+                timeout.total_seconds() if timeout is not None else None
+            ):
                 if dataset is DataSetType.MEASURE:
-                    data.update(await self.get_direct_reading_data())
+                    data = await self.get_direct_reading_data()
 
                 elif dataset is DataSetType.HISTORICAL_CONSUMPTION:
-                    data.update(await self.get_historical_consumption_data())
+                    data = await self.get_historical_consumption_data()
 
                 elif dataset is DataSetType.HISTORICAL_GENERATION:
-                    data.update(await self.get_historical_generation_data())
+                    data = await self.get_historical_generation_data()
 
                 elif dataset is DataSetType.HISTORICAL_POWER_DEMAND:
-                    data.update(await self.get_historical_power_demand_data())
+                    data = await self.get_historical_power_demand_data()
 
                 else:
                     _LOGGER.debug(
                         f"update ignored for {dataset.name}: not implemented yet"
                     )
-                    continue
-
-            except UnicodeDecodeError:
-                _LOGGER.debug(
-                    f"update error for {dataset.name}: invalid encoding. File a bug"
-                )
-                continue
-
-            except ideenergy.RequestFailedError as e:
-                _LOGGER.debug(
-                    f"update error for {dataset.name}: "
-                    + f"{e.response.reason} ({e.response.status})"
-                )
-                continue
-
-            except ideenergy.CommandError as e:
-                _LOGGER.debug(
-                    f"update error for {dataset.name}: command error from API ({e!r})"
-                )
-                continue
-
-            except Exception as e:
-                _LOGGER.debug(
-                    f"update error for {dataset.name}: "
-                    + f"**FIXME** handle {dataset.name} raised exception: {e!r}"
-                )
-                continue
-
-            self.barriers[dataset].success()
-
-            _LOGGER.debug(f"update successful for {dataset.name}")
-
-        # delay = random.randint(DELAY_MIN_SECONDS * 10, DELAY_MAX_SECONDS * 10) / 10
-        # _LOGGER.debug(f"  → Random delay: {delay} seconds")
-        # await asyncio.sleep(delay)
+                    return {}
+
+        except TimeoutError:
+            _LOGGER.debug(f"update error for {dataset.name}: timeout ({timeout})")
+            self.barrier.fail()
+            return {}
+
+        except RateLimitDeferredError as e:
+            # Not an i-DE failure, barrier is not affected
+            _LOGGER.debug(f"update deferred for {dataset.name}: {e.reason}")
+            return {}
+
+        except UnicodeDecodeError:
+            _LOGGER.debug(
+                f"update error for {dataset.name}: invalid encoding. File a bug"
+            )
+            self.barrier.fail()
+            return {}
+
+        except ideenergy.RequestFailedError as e:
+            _LOGGER.debug(
+                f"update error for {dataset.name}: "
+                + f"{e.response.reason} ({e.response.status})"
+            )
+            self.barrier.fail()
+            return {}
+
+        except ideenergy.CommandError as e:
+            _LOGGER.debug(
+                f"update error for {dataset.name}: command error from API ({e!r})"
+            )
+            self.barrier.fail()
+            return {}
+
+        except Exception as e:
+            _LOGGER.debug(
+                f"update error for {dataset.name}: "
+                + f"**FIXME** handle {dataset.name} raised exception: {e!r}"
+            )
+            self.barrier.fail()
+            return {}
+
+        self.barrier.success()
+
+        _LOGGER.debug(f"update successful for {dataset.name}")
+
+        # Unchanged data is not stored so entities don't convert or write it again
+        fingerprint = _build_fingerprint(data)
+        if fingerprint is not None:
+            if self._fingerprints.get(dataset) == fingerprint:
+                _LOGGER.debug(f"update for {dataset.name}: data not modified")
+                return {}
+
+            self._fingerprints[dataset] = fingerprint
 
         return data
 
     def register_sensor(self, sensor: IDeEntity) -> None:
         self.sensors.append(sensor)
+        self._datasets_refcount.update(sensor.I_DE_DATA_SETS)
+        self._update_requested_datasets()
         _LOGGER.debug(f"Registered sensor '{sensor.__class__.__name__}'")
 
     def unregister_sensor(self, sensor: IDeEntity) -> None:
+        if sensor not in self.sensors:
+            return
+
         self.sensors.remove(sensor)
+        self._datasets_refcount.subtract(sensor.I_DE_DATA_SETS)
+        self._update_requested_datasets()
         _LOGGER.debug(f"Unregistered sensor '{sensor.__class__.__name__}'")
 
+    def _update_requested_datasets(self) -> None:
+        self.requested_datasets = DataSetType.NONE
+        for dataset, count in self._datasets_refcount.items():
+            if count > 0:
+                self.requested_datasets = self.requested_datasets | dataset
+
+        # Sensors may be interested in other datasets too, those are handled by
+        # their own coordinators
+        self.requested_datasets = self.requested_datasets & self.dataset
+
     def update_internal_data(self, data: dict[str, Any]):
         self.data = self.data | data  # type: ignore[assignment]
 
@@ -241,19 +418,98 @@ class IDeCoordinator(DataUpdateCoordinator):
 
     async def get_historical_consumption_data(self) -> Any:
         end = datetime.today()
-        start = end - HISTORICAL_PERIOD_LENGHT
+        start = await self._async_get_historical_start(
+            DataSetType.HISTORICAL_CONSUMPTION, end
+        )
         data = await self.api.get_historical_consumption(start=start, end=end)
 
-        return {DATA_ATTR_HISTORICAL_CONSUMPTION: data}
+        return {
+            DATA_ATTR_HISTORICAL_CONSUMPTION: HistoricalPeriods.from_period_values(
+                data.periods
+            )
+        }
 
     async def get_historical_generation_data(self) -> Any:
         end = datetime.today()
-        start = end - HISTORICAL_PERIOD_LENGHT
+        start = await self._async_get_historical_start(
+            DataSetType.HISTORICAL_GENERATION, end
+        )
         data = await self.api.get_historical_generation(start=start, end=end)
 
-        return {DATA_ATTR_HISTORICAL_GENERATION: data}
+        return {
+            DATA_ATTR_HISTORICAL_GENERATION: HistoricalPeriods.from_period_values(
+                data.periods
+            )
+        }
+
+    async def _async_get_historical_start(
+        self, dataset: DataSetType, end: datetime
+    ) -> datetime:
+        # Start from the newest statistic already stored by the sensors of this
+        # dataset. Fallback to the full period if any of them has nothing stored
+        default = end - HISTORICAL_PERIOD_LENGHT
+
+        sensors = [
+            x
+            for x in self.sensors
+            if dataset in x.I_DE_DATA_SETS
+            and hasattr(x, "async_get_last_statistic_start")
+        ]
+        if not sensors:
+            return default
+
+        last_starts = [await x.async_get_last_statistic_start() for x in sensors]
+        if any(x is None for x in last_starts):
+            return default
+
+        start = dt_util.as_local(min(last_starts)).replace(tzinfo=None)
+        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        start = max(default, start - HISTORICAL_PERIOD_OVERLAP)
+
+        _LOGGER.debug(f"incremental update for {dataset.name} since {start}")
+        return start
+
+    async def async_fetch_historical_periods(
+        self, dataset: DataSetType, start: date, end: date
+    ) -> HistoricalPeriods:
+        """Periods starting within [start, end) (local dates), used for backfills"""
+
+        start_dt = datetime.combine(start, time.min)
+        end_dt = datetime.combine(end, time.min)
+
+        # API drops periods ending at 'end', ask for one more day and filter them
+        if dataset is DataSetType.HISTORICAL_CONSUMPTION:
+            data = await self.api.get_historical_consumption(
+                start=start_dt, end=end_dt + timedelta(days=1)
+            )
+        elif dataset is DataSetType.HISTORICAL_GENERATION:
+            data = await self.api.get_historical_generation(
+                start=start_dt, end=end_dt + timedelta(days=1)
+            )
+        else:
+            raise ValueError(f"{dataset.name} doesn't provide periods")
+
+        return HistoricalPeriods.from_period_values(
+            x for x in data.periods if start_dt <= x.start < end_dt
+        )
 
     async def get_historical_power_demand_data(self) -> Any:
         data = await self.api.get_historical_power_demand()
 
-        return {DATA_ATTR_HISTORICAL_POWER_DEMAND: data}
+        return {
+            DATA_ATTR_HISTORICAL_POWER_DEMAND: HistoricalDemands.from_demands_at_instant(
+                data.demands
+            )
+        }
+
+
+def _build_fingerprint(data: dict[str, Any]) -> int | None:
+    items: list[int] = []
+
+    for value in data.values():
+        if not isinstance(value, (HistoricalPeriods, HistoricalDemands)):
+            return None
+
+        items.append(value.fingerprint())
+
+    return hash(tuple(items))
@@ -20,20 +20,23 @@
 # Maybe we need to mark some function as callback but I'm not sure whose.
 # from homeassistant.core import callback
 
+import enum
+import functools
 import logging
+import operator
 
-from homeassistant.components import recorder
 from homeassistant.helpers.entity import DeviceInfo
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 from homeassistant.util import slugify
-from homeassistant_historical_sensor.recorderutil import (
-    delete_entity_invalid_states,
-    hass_recorder_session,
-)
 
 SensorType = type["IDeEntity"]
 
 
+class IDeEntityFeature(enum.IntFlag):
+    # Entity provides the backfill service (statistics sensors)
+    BACKFILL = 1
+
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -53,6 +56,13 @@ class IDeEntity(CoordinatorEntity):
     def __init__(self, *args, config_entry, device_info, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Coordinator only notifies entities whose datasets have been updated
+        self.coordinator_context = (
+            functools.reduce(operator.or_, self.I_DE_DATA_SETS)
+            if self.I_DE_DATA_SETS
+            else None
+        )
+
         self._attr_has_entity_name = True
         self._attr_name = self.I_DE_ENTITY_NAME
 
@@ -70,36 +80,25 @@ class IDeEntity(CoordinatorEntity):
     def __repr__(self):
         clsname = self.__class__.__name__
         if hasattr(self, "coordinator"):
-            api = self.coordinator.api.username
+            api = self.coordinator.api
         else:
             api = self.api
 
-        return f"<{clsname} {api.username}/{api._contract}>"
+        return f"<{clsname} {api.username}/{api.contract}>"
 
     async def async_added_to_hass(self) -> None:
-        n_invalid_states = await self.async_delete_invalid_states()
-        _LOGGER.debug(f"{self.entity_id}: cleaned {n_invalid_states} invalid states")
-
         await super().async_added_to_hass()
 
+        # Invalid states (and statistics) are cleaned along with other entities in
+        # a single recorder job
+        self.coordinator.maintenance.async_schedule(self)
         self.coordinator.register_sensor(self)
 
-        await self.coordinator.async_request_refresh()
-
     async def async_will_remove_from_hass(self) -> None:
+        self.coordinator.maintenance.async_unschedule(self)
         self.coordinator.unregister_sensor(self)
         await super().async_will_remove_from_hass()
 
-    async def async_delete_invalid_states(self) -> int:
-        if getattr(self, "hass", None) is None:
-            raise TypeError(f"{self.entity_id} is not added to hass")
-
-        def fn():
-            with hass_recorder_session(self.hass) as session:
-                return delete_entity_invalid_states(session, self)
-
-        return await recorder.get_instance(self.hass).async_add_executor_job(fn)
-
 
 def _build_entity_unique_id(device_info: DeviceInfo, entity_unique_name: str) -> str:
     cups = dict(device_info["identifiers"])["cups"]
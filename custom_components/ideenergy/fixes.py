@@ -17,223 +17,297 @@
 
 
 import logging
+from typing import Any
 
 import sqlalchemy as sa
-from homeassistant.components import recorder
 from homeassistant.components.recorder import db_schema, statistics
 from homeassistant.core import HomeAssistant, dt_util
-from homeassistant_historical_sensor import recorderutil
+from homeassistant.helpers.singleton import singleton
+
+from .const import DOMAIN
+from .store import StoredDict
 
 _LOGGER = logging.getLogger(__name__)
 
+DATA_WATERMARKS = f"{DOMAIN}_statistics_watermarks"
+STORE_KEY = f"{DOMAIN}.statistics_watermarks"
+RECALCULATE_BATCH_SIZE = 1000
 
-async def async_fix_statistics(
-    hass: HomeAssistant, statistic_metadata: statistics.StatisticMetaData
-) -> None:
-    def timestamp_as_local(timestamp):
-        return dt_util.as_local(dt_util.utc_from_timestamp(timestamp))
 
-    def fn():
-        fixes_applied = False
+@singleton(DATA_WATERMARKS)
+async def async_get_statistics_watermarks(hass: HomeAssistant) -> StoredDict:
+    """Metadata flags and last start_ts already checked for each statistic"""
 
-        statistic_id = statistic_metadata["statistic_id"]
-        statistic_metadata_has_mean = statistic_metadata.get("has_mean", False)
-        statistic_metadata_has_sum = statistic_metadata.get("has_sum", False)
+    watermarks = StoredDict(hass, STORE_KEY)
+    await watermarks.async_load()
+    return watermarks
 
-        with recorderutil.hass_recorder_session(hass) as session:
-            #
-            # Check and fix current metadata
-            #
 
-            current_metadata = session.execute(
-                sa.select(db_schema.StatisticsMeta).where(
-                    db_schema.StatisticsMeta.statistic_id == statistic_id
-                )
-            ).scalar()
+def fix_statistics(
+    session,
+    statistic_metadata: statistics.StatisticMetaData,
+    watermark: dict[str, Any] | None,
+) -> tuple[dict[str, Any] | None, bool]:
+    """Fix statistics using an existing session, changes are not commited.
 
-            if current_metadata is None:
-                _LOGGER.debug(f"{statistic_id}: no statistics found, nothing to fix")
-                return
-
-            statistics_base_stmt = sa.select(db_schema.Statistics).where(
-                db_schema.Statistics.metadata_id == current_metadata.id
-            )
+    Statistics after a broken point are repaired in place, rebuilding sum (and
+    mean) from state.
 
-            metadata_needs_fixes = (
-                current_metadata.has_mean != statistic_metadata_has_mean
-            ) or (current_metadata.has_sum != statistic_metadata_has_sum)
-
-            if metadata_needs_fixes:
-                _LOGGER.debug(
-                    f"{statistic_id}: statistic metadata is outdated."
-                    f" has_mean:{current_metadata.has_mean}→{statistic_metadata_has_mean}"
-                    f" has_sum:{current_metadata.has_sum}→{statistic_metadata_has_sum}"
-                )
-                current_metadata.has_mean = statistic_metadata_has_mean
-                current_metadata.has_sum = statistic_metadata_has_sum
-                session.add(current_metadata)
-                session.commit()
-                fixes_applied = True
-
-            #
-            # Check for broken points and decreasings
-            #
-            broken_point = None
-
-            prev_sum = 0
-            statistics_iter_stmt = statistics_base_stmt.order_by(
-                db_schema.Statistics.start_ts.asc()
-            )
+    Returns the new watermark and if any fix has been applied.
+    """
 
-            for statistic in session.execute(statistics_iter_stmt).scalars():
-                is_broken = False
-                local_start_dt = timestamp_as_local(statistic.start_ts)
-
-                # Check for NULL mean
-                if statistic_metadata_has_mean and statistic.mean is None:
-                    is_broken = True
-                    _LOGGER.debug(
-                        f"{statistic_id}: mean value at {local_start_dt} is NULL"
-                    )
-
-                # Check for NULL sum
-                if statistic_metadata_has_sum and statistic.sum is None:
-                    is_broken = True
-                    _LOGGER.debug(
-                        f"{statistic_id}: sum value at {local_start_dt} is NULL"
-                    )
-
-                # Check for decreasing values in sum
-                if statistic_metadata_has_sum and statistic.sum:
-                    if statistic.sum < prev_sum:
-                        is_broken = True
-                        _LOGGER.debug(
-                            f"{statistic_id}: "
-                            + f"decreasing sum at {local_start_dt} "
-                            + f"{statistic.sum} < {prev_sum} ({statistic!r})"
-                        )
-                    else:
-                        prev_sum = statistic.sum
-
-                # Found anything broken?
-                if is_broken:
-                    broken_point = statistic.start_ts
-                    break
-
-            #
-            # Check for broken points (search only for NULLs)
-            #
-
-            # clauses_for_additional_or_ = [db_schema.Statistics.state == None]
-            # if statistic_metadata_has_mean:
-            #     clauses_for_additional_or_.append(db_schema.Statistics.mean == None)
-            # if statistic_metadata_has_sum:
-            #     clauses_for_additional_or_.append(db_schema.Statistics.sum == None)
-
-            # find_broken_point_stmt = (
-            #     sa.select(sa.func.min(db_schema.Statistics.start_ts))
-            #     .where(db_schema.Statistics.metadata_id == current_metadata.id)
-            #     .where(sa.or_(*clauses_for_additional_or_))
-            # )
-
-            # broken_point = session.execute(find_broken_point_stmt).scalar()
-
-            #
-            # Delete everything after broken point
-            #
-            if broken_point:
-                invalid_statistics_stmt = statistics_base_stmt.where(
-                    db_schema.Statistics.start_ts >= broken_point
-                )
-                invalid_statistics = (
-                    session.execute(invalid_statistics_stmt).scalars().fetchall()
-                )
-
-                for x in invalid_statistics:
-                    session.delete(x)
-
-                session.commit()
-                fixes_applied = True
-
-                _LOGGER.debug(
-                    f"{statistic_id}: "
-                    f"found broken point at {timestamp_as_local(broken_point)},"
-                    f" deleted {len(invalid_statistics)} statistics"
-                )
-
-            #
-            # Delete additional statistics
-            #
-
-            clauses_for_additional_or_ = [db_schema.Statistics.state == None]
-
-            if statistic_metadata_has_mean:
-                clauses_for_additional_or_.append(db_schema.Statistics.mean == None)
-
-            if statistic_metadata_has_sum:
-                clauses_for_additional_or_.append(db_schema.Statistics.sum == None)
-
-            invalid_statistics_stmt = statistics_base_stmt.where(
-                sa.or_(*clauses_for_additional_or_)
-            )
+    def timestamp_as_local(timestamp):
+        return dt_util.as_local(dt_util.utc_from_timestamp(timestamp))
 
-            invalid_statistics = (
-                session.execute(invalid_statistics_stmt).scalars().fetchall()
+    fixes_applied = False
+
+    statistic_id = statistic_metadata["statistic_id"]
+    statistic_metadata_has_mean = statistic_metadata.get("has_mean", False)
+    statistic_metadata_has_sum = statistic_metadata.get("has_sum", False)
+
+    #
+    # Check and fix current metadata
+    #
+
+    current_metadata = session.execute(
+        sa.select(db_schema.StatisticsMeta).where(
+            db_schema.StatisticsMeta.statistic_id == statistic_id
+        )
+    ).scalar()
+
+    if current_metadata is None:
+        _LOGGER.debug(f"{statistic_id}: no statistics found, nothing to fix")
+        return None, False
+
+    metadata_needs_fixes = (
+        current_metadata.has_mean != statistic_metadata_has_mean
+    ) or (current_metadata.has_sum != statistic_metadata_has_sum)
+
+    if metadata_needs_fixes:
+        _LOGGER.debug(
+            f"{statistic_id}: statistic metadata is outdated."
+            f" has_mean:{current_metadata.has_mean}→{statistic_metadata_has_mean}"
+            f" has_sum:{current_metadata.has_sum}→{statistic_metadata_has_sum}"
+        )
+        current_metadata.has_mean = statistic_metadata_has_mean
+        current_metadata.has_sum = statistic_metadata_has_sum
+        session.add(current_metadata)
+        fixes_applied = True
+
+    #
+    # Check only statistics newer than the watermark (if still valid)
+    #
+
+    since = None
+    if (
+        watermark is not None
+        and not metadata_needs_fixes
+        and watermark["has_mean"] == statistic_metadata_has_mean
+        and watermark["has_sum"] == statistic_metadata_has_sum
+    ):
+        since = watermark["checked_until"]
+
+    last_start_ts = _get_last_start_ts(session, current_metadata.id)
+    if last_start_ts is None:
+        _LOGGER.debug(f"{statistic_id}: no statistics found, nothing to fix")
+        return None, fixes_applied
+
+    if since is not None and last_start_ts < since:
+        # Statistics deleted by someone else, check everything
+        since = None
+
+    if since is not None and last_start_ts == since:
+        _LOGGER.debug(
+            f"{statistic_id}: no new statistics since last check "
+            + f"({timestamp_as_local(since)})"
+        )
+        return watermark, fixes_applied
+
+    if since is not None:
+        _LOGGER.debug(
+            f"{statistic_id}: checking statistics since "
+            + f"{timestamp_as_local(since)}"
+        )
+
+    #
+    # Check for broken points: NULLs and decreasings (done by the database)
+    #
+
+    broken_point = session.execute(
+        _find_broken_point_stmt(
+            current_metadata.id,
+            has_mean=statistic_metadata_has_mean,
+            has_sum=statistic_metadata_has_sum,
+            since=since,
+        )
+    ).scalar()
+
+    if broken_point is not None:
+        _LOGGER.debug(
+            f"{statistic_id}: "
+            f"found broken point at {timestamp_as_local(broken_point)}"
+        )
+
+    #
+    # Repair: statistics without state can't be recovered, delete them.
+    # Then recalculate everything after the broken point.
+    #
+
+    delete_stmt = (
+        sa.delete(db_schema.Statistics)
+        .where(db_schema.Statistics.metadata_id == current_metadata.id)
+        .where(db_schema.Statistics.state == None)
+        .execution_options(synchronize_session=False)
+    )
+    if since is not None:
+        delete_stmt = delete_stmt.where(db_schema.Statistics.start_ts >= since)
+
+    n_deleted = session.execute(delete_stmt).rowcount
+
+    n_recalculated = 0
+    if broken_point is not None:
+        n_recalculated = _recalculate_statistics(
+            session,
+            current_metadata.id,
+            broken_point,
+            has_mean=statistic_metadata_has_mean,
+            has_sum=statistic_metadata_has_sum,
+        )
+
+    if n_deleted or n_recalculated:
+        fixes_applied = True
+
+    if n_deleted:
+        _LOGGER.debug(
+            f"{statistic_id}: "
+            f"deleted {n_deleted} broken statistics or with invalid attributes"
+        )
+
+    if n_recalculated:
+        _LOGGER.debug(
+            f"{statistic_id}: "
+            f"recalculated {n_recalculated} statistics since "
+            f"{timestamp_as_local(broken_point)}"
+        )
+
+    if not fixes_applied:
+        _LOGGER.debug(f"{statistic_id}: no problems found")
+
+    if n_deleted:
+        last_start_ts = _get_last_start_ts(session, current_metadata.id)
+
+    if last_start_ts is None:
+        return None, fixes_applied
+
+    return {
+        "has_mean": statistic_metadata_has_mean,
+        "has_sum": statistic_metadata_has_sum,
+        "checked_until": last_start_ts,
+    }, fixes_applied
+
+
+def _recalculate_statistics(
+    session, metadata_id: int, since: float, *, has_mean: bool, has_sum: bool
+) -> int:
+    if not has_mean and not has_sum:
+        return 0
+
+    base = session.execute(
+        sa.select(db_schema.Statistics.sum)
+        .where(db_schema.Statistics.metadata_id == metadata_id)
+        .where(db_schema.Statistics.start_ts < since)
+        .where(db_schema.Statistics.sum != None)
+        .order_by(db_schema.Statistics.start_ts.desc())
+        .limit(1)
+    ).scalar()
+
+    # Statistics are paged by start_ts (unique for each metadata_id), only one page
+    # of (id, start_ts, state) tuples is kept in memory. Results are not streamed,
+    # some database drivers can't run the updates while a cursor is open
+    accumulated = base or 0
+    n = 0
+    after = None
+
+    while True:
+        stmt = (
+            sa.select(
+                db_schema.Statistics.id,
+                db_schema.Statistics.start_ts,
+                db_schema.Statistics.state,
             )
-
-            if invalid_statistics:
-                for o in invalid_statistics:
-                    session.delete(o)
-                session.commit()
-                fixes_applied = True
-
-                _LOGGER.debug(
-                    f"{statistic_id}: "
-                    f"deleted {len(invalid_statistics)} statistics with invalid attributes"
-                )
-
-            if not fixes_applied:
-                _LOGGER.debug(f"{statistic_id}: no problems found")
-
-            #
-            # Recalculate
-            #
-
-            # if not broken_point and not force_recalculate:
-            #     return
-
-            # if broken_point:
-            #     _LOGGER.debug(
-            #         f"{statistic_id}: found broken statistics since"
-            #         f" {timestamp_as_local(broken_point.start_ts)},"
-            #         f" recalculating everything from there"
-            #     )
-
-            #
-            # Recalculate all stats
-            #
-
-            # accumulated = 0
-            # for statistic in session.execute(
-            #     sa.select(db_schema.Statistics)
-            #     .where(db_schema.Statistics.metadata_id == statistic_id)
-            #     .order_by(db_schema.Statistics.start_ts.asc)
-            # ):
-            #     accumulated = accumulated + statistic.state
-
-            #     # fmt: off
-            #     statistic.mean = statistic.state if statistic_metadata_has_mean else None
-            #     statistic.sum = accumulated if statistic_metadata_has_sum else None
-            #     statistic.min = None
-            #     statistic.max = None
-            #     # fmt: on
-
-            #     session.add(statistic)
-            #     _LOGGER.debug(
-            #         f"{statistic_id}: "
-            #         f"update {statistic.id} {timestamp_as_local(statistic.start_ts)} "
-            #         f"value={statistic.value}\tsum={statistic.sum}"
-            #     )
-            # session.commit()
-
-    return await recorder.get_instance(hass).async_add_executor_job(fn)
+            .where(db_schema.Statistics.metadata_id == metadata_id)
+            .where(db_schema.Statistics.state != None)
+            .order_by(db_schema.Statistics.start_ts.asc())
+            .limit(RECALCULATE_BATCH_SIZE)
+        )
+        if after is None:
+            stmt = stmt.where(db_schema.Statistics.start_ts >= since)
+        else:
+            stmt = stmt.where(db_schema.Statistics.start_ts > after)
+
+        rows = session.execute(stmt).all()
+        if not rows:
+            break
+
+        batch: list[dict[str, Any]] = []
+        for row in rows:
+            accumulated = accumulated + row.state
+
+            values: dict[str, Any] = {"id": row.id}
+            if has_sum:
+                values["sum"] = accumulated
+            if has_mean:
+                values["mean"] = row.state
+
+            batch.append(values)
+
+        session.execute(sa.update(db_schema.Statistics), batch)
+        n = n + len(batch)
+        after = rows[-1].start_ts
+
+    return n
+
+
+def _get_last_start_ts(session, metadata_id: int) -> float | None:
+    return session.execute(
+        sa.select(sa.func.max(db_schema.Statistics.start_ts)).where(
+            db_schema.Statistics.metadata_id == metadata_id
+        )
+    ).scalar()
+
+
+def _find_broken_point_stmt(
+    metadata_id: int, *, has_mean: bool, has_sum: bool, since: float | None = None
+) -> sa.Select:
+    """Start of the first statistic with NULLs or a decreasing sum"""
+
+    prev_sum = (
+        sa.func.lag(db_schema.Statistics.sum)
+        .over(order_by=db_schema.Statistics.start_ts.asc())
+        .label("prev_sum")
+    )
+    ordered = (
+        sa.select(
+            db_schema.Statistics.start_ts,
+            db_schema.Statistics.mean,
+            db_schema.Statistics.sum,
+            prev_sum,
+        )
+        .where(db_schema.Statistics.metadata_id == metadata_id)
+        .where(
+            db_schema.Statistics.start_ts >= since if since is not None else sa.true()
+        )
+        .subquery()
+    )
+
+    clauses_for_or_ = []
+    if has_mean:
+        clauses_for_or_.append(ordered.c.mean == None)
+    if has_sum:
+        clauses_for_or_.append(ordered.c.sum == None)
+        clauses_for_or_.append(ordered.c.sum < ordered.c.prev_sum)
+
+    if not clauses_for_or_:
+        clauses_for_or_.append(sa.false())
+
+    return sa.select(sa.func.min(ordered.c.start_ts)).where(sa.or_(*clauses_for_or_))
@@ -0,0 +1,99 @@
+# Copyright (C) 2021-2022 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+#
+# Compact, columnar, representation of historical data from the API.
+#
+# ideenergy returns a PeriodValue (two datetimes and a float) for each hour, and
+# coordinator keeps them in memory for as long as HA runs. Datetimes are stored
+# here as epoch seconds and values as doubles.
+#
+
+
+from array import array
+from collections.abc import Iterable
+from datetime import datetime
+
+from ideenergy.types import DemandAtInstant, PeriodValue
+
+from .const import MAINLAND_SPAIN_ZONEINFO
+
+
+class HistoricalPeriods:
+    """Periods (start, end, value) sorted by start"""
+
+    __slots__ = ("starts", "ends", "values")
+
+    def __init__(self, starts: array, ends: array, values: array):
+        self.starts = starts
+        self.ends = ends
+        self.values = values
+
+    @classmethod
+    def from_period_values(cls, periods: Iterable[PeriodValue]) -> "HistoricalPeriods":
+        starts, ends, values = array("q"), array("q"), array("d")
+
+        for item in periods:
+            starts.append(local_datetime_as_timestamp(item.start))
+            ends.append(local_datetime_as_timestamp(item.end))
+            values.append(item.value)
+
+        return cls(starts, ends, values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def fingerprint(self) -> int:
+        return hash((self.starts.tobytes(), self.ends.tobytes(), self.values.tobytes()))
+
+
+class HistoricalDemands:
+    """Power demand peaks (timestamp, value) sorted by timestamp"""
+
+    __slots__ = ("timestamps", "values")
+
+    def __init__(self, timestamps: array, values: array):
+        self.timestamps = timestamps
+        self.values = values
+
+    @classmethod
+    def from_demands_at_instant(
+        cls, demands: Iterable[DemandAtInstant]
+    ) -> "HistoricalDemands":
+        timestamps, values = array("q"), array("d")
+
+        for item in demands:
+            timestamps.append(local_datetime_as_timestamp(item.dt))
+            values.append(item.value)
+
+        return cls(timestamps, values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def fingerprint(self) -> int:
+        return hash((self.timestamps.tobytes(), self.values.tobytes()))
+
+
+def local_datetime_as_timestamp(dt: datetime) -> int:
+    # FIXME: What about canary islands?
+    return int(dt.replace(tzinfo=MAINLAND_SPAIN_ZONEINFO).timestamp())
+
+
+def timestamp_as_local_datetime(timestamp: int) -> datetime:
+    return datetime.fromtimestamp(timestamp, MAINLAND_SPAIN_ZONEINFO)
@@ -0,0 +1,169 @@
+# Copyright (C) 2021-2022 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import asyncio
+import logging
+import time
+from typing import Any
+
+import sqlalchemy.exc
+from homeassistant.components import recorder
+from homeassistant.core import CALLBACK_TYPE, HomeAssistant, callback
+from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import async_call_later
+from homeassistant_historical_sensor.recorderutil import (
+    delete_entity_invalid_states,
+    hass_recorder_session,
+)
+
+from .fixes import async_get_statistics_watermarks, fix_statistics
+
+_LOGGER = logging.getLogger(__name__)
+
+MAINTENANCE_DELAY = 1  # Seconds to wait for other entities being added
+
+
+class RecorderMaintenance:
+    """Startup recorder maintenance for a group of entities.
+
+    Entities are scheduled as they are added to hass and handled together in a
+    single recorder job using one session: invalid states are deleted and, for
+    entities with statistics, those are checked and fixed.
+    """
+
+    def __init__(self, hass: HomeAssistant):
+        self.hass = hass
+        self._pending: list[Entity] = []
+        self._lock = asyncio.Lock()
+        self._cancel_timer: CALLBACK_TYPE | None = None
+
+    @callback
+    def async_schedule(self, entity: Entity) -> None:
+        self._pending.append(entity)
+
+        if self._cancel_timer is None:
+            self._cancel_timer = async_call_later(
+                self.hass, MAINTENANCE_DELAY, self._async_timer_fired
+            )
+
+    @callback
+    def async_unschedule(self, entity: Entity) -> None:
+        if entity in self._pending:
+            self._pending.remove(entity)
+
+    @callback
+    def async_cancel(self) -> None:
+        if self._cancel_timer is not None:
+            self._cancel_timer()
+            self._cancel_timer = None
+
+        self._pending = []
+
+    async def _async_timer_fired(self, _now) -> None:
+        self._cancel_timer = None
+        await self.async_run()
+
+    async def async_run(self) -> None:
+        """Run maintenance for all pending entities, waits for any running one"""
+
+        async with self._lock:
+            if not self._pending:
+                return
+
+            entities, self._pending = self._pending, []
+            try:
+                await self._async_run(entities)
+            except Exception as e:
+                _LOGGER.error(f"recorder maintenance failed: {e!r}")
+
+    async def _async_run(self, entities: list[Entity]) -> None:
+        watermarks = await async_get_statistics_watermarks(self.hass)
+
+        # Statistic metadata and watermarks are collected here, in the event loop
+        with_statistics = {
+            x.entity_id: (
+                x.get_statistic_metadata(),
+                watermarks.get(x.statistic_id),
+            )
+            for x in entities
+            if getattr(x, "statistic_id", None) is not None
+        }
+
+        def fn() -> dict[str, tuple[dict[str, Any] | None, bool]]:
+            # Only committed fixes are returned
+            fixes = {}
+
+            with hass_recorder_session(self.hass) as session:
+                for entity in entities:
+                    try:
+                        n_invalid_states = delete_entity_invalid_states(session, entity)
+                        _LOGGER.debug(
+                            f"{entity.entity_id}: "
+                            + f"cleaned {n_invalid_states} invalid states"
+                        )
+
+                    except sqlalchemy.exc.IntegrityError:
+                        session.rollback()
+                        _LOGGER.debug(
+                            f"{entity.entity_id}: invalid states can't be deleted"
+                        )
+
+                    if entity.entity_id not in with_statistics:
+                        continue
+
+                    #
+                    # In 2.0 branch we f**ked statistiscs.
+                    # Don't set state_class attributes for historical sensors!
+                    #
+                    # FIXME: Remove in future 3.0 series.
+                    #
+                    metadata, watermark = with_statistics[entity.entity_id]
+                    try:
+                        ret = fix_statistics(session, metadata, watermark)
+                        # Commit now, a later rollback must not discard these fixes
+                        session.commit()
+
+                    except sqlalchemy.exc.SQLAlchemyError as e:
+                        # Watermark is not updated, fixes will be retried next time
+                        session.rollback()
+                        _LOGGER.error(
+                            f"{entity.entity_id}: statistics can't be fixed ({e!r})"
+                        )
+                        continue
+
+                    fixes[entity.entity_id] = ret
+
+            return fixes
+
+        t0 = time.monotonic()
+        fixes = await recorder.get_instance(self.hass).async_add_executor_job(fn)
+        _LOGGER.debug(
+            f"recorder maintenance for {len(entities)} entities "
+            + f"done in {time.monotonic() - t0:.3f} seconds"
+        )
+
+        for entity in entities:
+            if entity.entity_id not in fixes:
+                continue
+
+            new_watermark, fixes_applied = fixes[entity.entity_id]
+            watermarks.set(entity.statistic_id, new_watermark)
+
+            # Statistics have been modified, cached ones are outdated
+            if fixes_applied and hasattr(entity, "invalidate_statistics_cache"):
+                entity.invalidate_statistics_cache()
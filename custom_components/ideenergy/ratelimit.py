@@ -0,0 +1,217 @@
+# Copyright (C) 2021-2022 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+#
+# Account-wide rate limiting. Every request to i-DE for an account (from any config
+# entry, config flows included) takes a token from the same per-minute and per-day
+# buckets.
+#
+# The per-day bucket is persisted so restarts and reloads don't reset it.
+#
+
+
+import asyncio
+import enum
+import logging
+import time
+from collections.abc import Callable
+from typing import Any
+
+from homeassistant.core import CALLBACK_TYPE, HomeAssistant, callback
+from homeassistant.helpers.singleton import singleton
+
+from .const import (
+    API_RATE_LIMIT_LOW_PRIORITY_RESERVE,
+    API_RATE_LIMIT_PER_DAY,
+    API_RATE_LIMIT_PER_MINUTE,
+    DOMAIN,
+)
+from .store import StoredDict
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_RATE_LIMITERS = f"{DOMAIN}_rate_limiters"
+DATA_RATE_LIMITS = f"{DOMAIN}_rate_limits"
+STORE_KEY = f"{DOMAIN}.rate_limits"
+
+
+class Priority(enum.IntEnum):
+    HIGH = 0  # Live measure, login, config flow
+    LOW = 1  # Historical data
+
+
+class RateLimitDeferredError(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period  # tokens per second
+
+        self._tokens = float(capacity)
+        self._ts = time.monotonic()
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens = self._tokens - 1
+
+    def time_until_available(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def as_dict(self) -> dict[str, Any]:
+        self._refill()
+        # Monotonic clock doesn't survive restarts, store wall clock
+        return {"tokens": self._tokens, "ts": time.time()}
+
+    def restore(self, data: dict[str, Any]) -> None:
+        elapsed = max(0.0, time.time() - float(data["ts"]))
+        self._tokens = min(float(self.capacity), float(data["tokens"]))
+        self._ts = time.monotonic() - elapsed
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.capacity), self._tokens + (now - self._ts) * self.rate
+        )
+        self._ts = now
+
+
+class RateLimiter:
+    """Per-minute and per-day request budgets.
+
+    Requests over the per-minute budget wait, higher priority ones first. Requests
+    over the per-day budget are deferred (RateLimitDeferredError). Low priority
+    requests are deferred earlier, keeping a reserve for high priority ones.
+    """
+
+    def __init__(
+        self,
+        per_minute: int = API_RATE_LIMIT_PER_MINUTE,
+        per_day: int = API_RATE_LIMIT_PER_DAY,
+        low_priority_reserve: int = API_RATE_LIMIT_LOW_PRIORITY_RESERVE,
+        *,
+        store: StoredDict | None = None,
+        store_key: str | None = None,
+    ):
+        self._minute = TokenBucket(per_minute, 60)
+        self._day = TokenBucket(per_day, 60 * 60 * 24)
+        self._low_priority_reserve = low_priority_reserve
+
+        self._store = store
+        self._store_key = store_key
+        if self._store is not None and (data := self._store.get(store_key)):
+            try:
+                self._day.restore(data)
+            except (KeyError, TypeError, ValueError) as e:
+                _LOGGER.debug(f"{store_key}: invalid per-day budget ({e!r})")
+
+        self._waiting = {x: 0 for x in Priority}
+        self._listeners: list[Callable[[], None]] = []
+
+    @property
+    def per_minute(self) -> int:
+        return self._minute.capacity
+
+    @property
+    def per_day(self) -> int:
+        return self._day.capacity
+
+    @property
+    def remaining_minute(self) -> int:
+        return int(self._minute.tokens)
+
+    @property
+    def remaining_day(self) -> int:
+        return int(self._day.tokens)
+
+    async def async_acquire(self, priority: Priority = Priority.HIGH) -> None:
+        self._check_day_budget(priority)
+
+        self._waiting[priority] = self._waiting[priority] + 1
+        try:
+            while True:
+                higher_priority_waiting = any(
+                    self._waiting[x] for x in Priority if x < priority
+                )
+                if self._minute.tokens >= 1 and not higher_priority_waiting:
+                    break
+
+                delay = max(self._minute.time_until_available(), 1)
+                _LOGGER.debug(
+                    f"per-minute budget exhausted, {priority.name} priority request "
+                    + f"waits {delay:.1f} seconds"
+                )
+                await asyncio.sleep(delay)
+
+        finally:
+            self._waiting[priority] = self._waiting[priority] - 1
+
+        # Day budget may have been consumed while waiting
+        self._check_day_budget(priority)
+
+        self._minute.take()
+        self._day.take()
+        if self._store is not None:
+            self._store.set(self._store_key, self._day.as_dict())
+
+        for update_callback in list(self._listeners):
+            update_callback()
+
+    def _check_day_budget(self, priority: Priority) -> None:
+        reserve = self._low_priority_reserve if priority is Priority.LOW else 0
+        if self._day.tokens < 1 + reserve:
+            raise RateLimitDeferredError(
+                f"per-day budget exhausted for {priority.name} priority requests "
+                + f"({self.remaining_day} left)"
+            )
+
+    @callback
+    def async_add_listener(self, update_callback: Callable[[], None]) -> CALLBACK_TYPE:
+        self._listeners.append(update_callback)
+
+        @callback
+        def remove_listener() -> None:
+            self._listeners.remove(update_callback)
+
+        return remove_listener
+
+
+@singleton(DATA_RATE_LIMITS)
+async def _async_get_rate_limits(hass: HomeAssistant) -> StoredDict:
+    rate_limits = StoredDict(hass, STORE_KEY)
+    await rate_limits.async_load()
+    return rate_limits
+
+
+async def async_get_rate_limiter(hass: HomeAssistant, username: str) -> RateLimiter:
+    rate_limits = await _async_get_rate_limits(hass)
+
+    limiters: dict[str, RateLimiter] = hass.data.setdefault(DATA_RATE_LIMITERS, {})
+    if username not in limiters:
+        limiters[username] = RateLimiter(store=rate_limits, store_key=username)
+
+    return limiters[username]
@@ -25,15 +25,18 @@
 # https://github.com/home-assistant/core/blob/dev/homeassistant/components/sensor/__init__.py
 
 
-import itertools
+import asyncio
 import logging
+from array import array
 from collections.abc import Callable
-from datetime import datetime, timedelta
+from datetime import date, datetime
 from typing import Any
 
+import voluptuous as vol
 from homeassistant.components import recorder
 from homeassistant.components.recorder import statistics
 from homeassistant.components.recorder.models import StatisticData, StatisticMetaData
+from homeassistant.components.recorder.statistics import async_import_statistics
 from homeassistant.components.sensor import (
     SensorDeviceClass,
     SensorEntity,
@@ -43,18 +46,34 @@ from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import (
     STATE_UNAVAILABLE,
     STATE_UNKNOWN,
+    EntityCategory,
     UnitOfEnergy,
     UnitOfPower,
 )
 from homeassistant.core import HomeAssistant, callback, dt_util
+from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers import entity_platform
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.restore_state import RestoreEntity
 from homeassistant.helpers.typing import DiscoveryInfoType
-from homeassistant.util import dt as dtutil
 from homeassistant_historical_sensor import HistoricalSensor, HistoricalState
-from ideenergy.types import PeriodValue
 
-from .const import DOMAIN
+from .backfill import (
+    BackfillCheckpoint,
+    async_get_backfill_checkpoints,
+    get_statistic_before,
+    iter_month_chunks,
+    local_date_as_timestamp,
+    shift_statistics_sum,
+)
+from .const import (
+    BACKFILL_DEFAULT_PACE,
+    CONF_STATISTICS_ONLY,
+    DEFAULT_STATISTICS_ONLY,
+    DOMAIN,
+    MAINLAND_SPAIN_ZONEINFO,
+    SERVICE_BACKFILL,
+)
 from .datacoordinator import (
     DATA_ATTR_HISTORICAL_CONSUMPTION,
     DATA_ATTR_HISTORICAL_GENERATION,
@@ -63,12 +82,17 @@ from .datacoordinator import (
     DATA_ATTR_MEASURE_INSTANT,
     DataSetType,
 )
-from .entity import IDeEntity
-from .fixes import async_fix_statistics
+from .entity import IDeEntity, IDeEntityFeature
+from .historicaldata import (
+    HistoricalDemands,
+    HistoricalPeriods,
+    timestamp_as_local_datetime,
+)
 
 PLATFORM = "sensor"
 
-MAINLAND_SPAIN_ZONEINFO = dtutil.zoneinfo.ZoneInfo("Europe/Madrid")
+_NOT_CACHED = object()
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -87,15 +111,75 @@ _LOGGER = logging.getLogger(__name__)
 
 
 class HistoricalSensorMixin(HistoricalSensor):
+    def __init__(self, *args, config_entry: ConfigEntry, **kwargs):
+        super().__init__(*args, config_entry=config_entry, **kwargs)
+
+        # Sensors with statistics can skip backdated states and write only them
+        self._statistics_only = config_entry.options.get(
+            CONF_STATISTICS_ONLY, DEFAULT_STATISTICS_ONLY
+        )
+
+        # historical_states conversion is cached during one write cycle only
+        self._historical_states_source: Any = None
+        self._historical_states_cache: list[HistoricalState] = []
+
     @callback
     def _handle_coordinator_update(self) -> None:
+        self._clear_historical_states_cache()
         self.hass.add_job(self.async_write_ha_historical_states())
 
+    def _memoized_historical_states(
+        self, data: Any, convert_fn: Callable[[Any], list[HistoricalState]]
+    ) -> list[HistoricalState]:
+        if data is not self._historical_states_source:
+            self._historical_states_cache = convert_fn(data)
+            self._historical_states_source = data
+
+        return self._historical_states_cache
+
+    def _clear_historical_states_cache(self) -> None:
+        self._historical_states_source = None
+        self._historical_states_cache = []
+
     def async_update_historical(self) -> None:
         pass
 
+    async def async_write_ha_historical_states(self):
+        # Don't keep the converted list alive between coordinator updates
+        try:
+            await self._async_write_ha_historical_states()
+        finally:
+            self._clear_historical_states_cache()
+
+    async def _async_write_ha_historical_states(self):
+        if not self._statistics_only or self.statistic_id is None:
+            await super().async_write_ha_historical_states()
+            return
+
+        hist_states = self.historical_states
+        _LOGGER.debug(
+            f"{self.entity_id}: "
+            + f"{len(hist_states)} historical states present in sensor"
+        )
+        if not hist_states:
+            return
+
+        # States are not written, import statistics from historical data directly
+        hist_states = list(sorted(hist_states, key=lambda x: x.dt))
+        n = len(await self._async_write_statistic_data(hist_states))
+        _LOGGER.debug(f"{self.entity_id}: {n} statistics points written into database")
+
 
 class StatisticsMixin(HistoricalSensor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._attr_supported_features = IDeEntityFeature.BACKFILL
+        self._backfill_task: asyncio.Task | None = None
+
+        # In-memory (start, sum) watermark of the last statistic, None means no
+        # statistics and _NOT_CACHED that the recorder must be queried again
+        self._last_statistic: dict | None | object = _NOT_CACHED
+
     @property
     def statistic_id(self):
         return self.entity_id
@@ -108,47 +192,160 @@ class StatisticsMixin(HistoricalSensor):
     async def async_added_to_hass(self):
         await super().async_added_to_hass()
 
-        #
-        # In 2.0 branch we f**ked statistiscs.
-        # Don't set state_class attributes for historical sensors!
-        #
-        # FIXME: Remove in future 3.0 series.
-        #
-        await async_fix_statistics(self.hass, self.get_statistic_metadata())
-
-    async def async_calculate_statistic_data(
-        self, hist_states: list[HistoricalState], *, latest: dict | None
-    ) -> list[StatisticData]:
-        #
-        # Filter out invalid states
-        #
+        # Statistics are fixed by the coordinator's recorder maintenance
 
-        n_original_hist_states = len(hist_states)
-        hist_states = [x for x in hist_states if x.state not in (0, None)]
-        if len(hist_states) != n_original_hist_states:
-            _LOGGER.warning(
-                f"{self.statistic_id}: "
-                + "found some weird values in historical statistics"
+        # Resume any interrupted backfill
+        checkpoints = await async_get_backfill_checkpoints(self.hass)
+        if checkpoint := checkpoints.get(self.statistic_id):
+            _LOGGER.debug(f"{self.statistic_id}: resuming backfill since {checkpoint}")
+            await self.async_backfill(
+                start=checkpoint.start, end=checkpoint.end, pace=checkpoint.pace
             )
 
-        #
-        # Group historical states by hour block
-        #
+    async def async_will_remove_from_hass(self) -> None:
+        if self._backfill_task is not None:
+            self._backfill_task.cancel()
+
+        await super().async_will_remove_from_hass()
 
-        def hour_block_for_hist_state(hist_state: HistoricalState) -> datetime:
-            # XX:00:00 states belongs to previous hour block
-            if hist_state.dt.minute == 0 and hist_state.dt.second == 0:
-                dt = hist_state.dt - timedelta(hours=1)
-                return dt.replace(minute=0, second=0, microsecond=0)
+    async def async_backfill(
+        self,
+        start: date,
+        end: date | None = None,
+        pace: float = BACKFILL_DEFAULT_PACE,
+    ) -> None:
+        """Entity service handler, backfill runs in the background"""
 
-            else:
-                return hist_state.dt.replace(minute=0, second=0, microsecond=0)
+        end = end or dt_util.now(MAINLAND_SPAIN_ZONEINFO).date()
+
+        if self._backfill_task is not None and not self._backfill_task.done():
+            _LOGGER.warning(f"{self.statistic_id}: backfill already running")
+            return
+
+        self._backfill_task = self.hass.async_create_background_task(
+            self._async_backfill(start, end, pace),
+            name=f"{self.statistic_id} backfill",
+        )
+
+    async def _async_backfill(self, start: date, end: date, pace: float) -> None:
+        # Don't import anything before statistics are fixed
+        await self.coordinator.maintenance.async_run()
 
         #
-        # Ignore supplied 'lastest' and fetch again from recorder
-        # FIXME: integrate into homeassistant_historical_sensor and remove
+        # Resume from checkpoint if it's the same backfill
         #
 
+        checkpoints = await async_get_backfill_checkpoints(self.hass)
+        checkpoint = checkpoints.get(self.statistic_id)
+        if checkpoint and checkpoint.start == start and checkpoint.end == end:
+            resume_from = checkpoint.next
+        else:
+            resume_from = start
+
+        _LOGGER.debug(
+            f"{self.statistic_id}: backfill from {resume_from} to {end} "
+            + f"(requested since {start}, pace: {pace} seconds)"
+        )
+
+        rec = recorder.get_instance(self.hass)
+        metadata = self.get_statistic_metadata()
+        dataset = self.I_DE_DATA_SETS[0]
+
+        try:
+            # Only one chunk is kept in memory at any time
+            for idx, (chunk_start, chunk_end) in enumerate(
+                iter_month_chunks(resume_from, end)
+            ):
+                if idx:
+                    await asyncio.sleep(pace)
+
+                try:
+                    periods = await self.coordinator.async_fetch_historical_periods(
+                        dataset, chunk_start, chunk_end
+                    )
+                except Exception as e:
+                    _LOGGER.warning(
+                        f"{self.statistic_id}: backfill of {chunk_start} "
+                        + f"failed ({e!r}), it will be resumed on next start"
+                    )
+                    return
+
+                chunk_start_ts = local_date_as_timestamp(chunk_start)
+                chunk_end_ts = local_date_as_timestamp(chunk_end)
+
+                base = await rec.async_add_executor_job(
+                    get_statistic_before, self.hass, self.statistic_id, chunk_start_ts
+                )
+                prev_end = await rec.async_add_executor_job(
+                    get_statistic_before, self.hass, self.statistic_id, chunk_end_ts
+                )
+
+                # Periods are bucketed straight from their arrays, no
+                # HistoricalState is built for backfills
+                statistic_data = await self.async_calculate_statistic_data_from_arrays(
+                    *statistic_arrays_from_periods(periods),
+                    latest=base,
+                    use_latest=True,
+                )
+
+                if statistic_data:
+                    async_import_statistics(self.hass, metadata, statistic_data)
+                    await rec.async_block_till_done()
+
+                    # Keep statistics after this chunk consistent with the new sums
+                    new_end = await rec.async_add_executor_job(
+                        get_statistic_before, self.hass, self.statistic_id, chunk_end_ts
+                    )
+                    delta = (new_end["sum"] if new_end else 0) - (
+                        prev_end["sum"] if prev_end else 0
+                    )
+                    if delta:
+                        await rec.async_add_executor_job(
+                            shift_statistics_sum,
+                            self.hass,
+                            self.statistic_id,
+                            chunk_end_ts,
+                            delta,
+                        )
+
+                        # Sums after this chunk have been shifted, live updates must
+                        # not use the cached one
+                        self.invalidate_statistics_cache()
+
+                await checkpoints.async_set(
+                    self.statistic_id,
+                    BackfillCheckpoint(start=start, end=end, next=chunk_end, pace=pace),
+                )
+                _LOGGER.debug(
+                    f"{self.statistic_id}: backfill imported {len(statistic_data)} "
+                    + f"statistics from {chunk_start} to {chunk_end}"
+                )
+
+            await checkpoints.async_remove(self.statistic_id)
+            _LOGGER.debug(f"{self.statistic_id}: backfill completed")
+
+        finally:
+            # Sums may have been shifted, even if the backfill was interrupted
+            self.invalidate_statistics_cache()
+
+    async def async_get_last_statistic_start(self) -> datetime | None:
+        """Start of the newest statistic already stored in the recorder"""
+        latest = await self._async_get_cached_last_statistics()
+        if not latest:
+            return None
+
+        return dt_util.utc_from_timestamp(latest["start"])
+
+    def invalidate_statistics_cache(self) -> None:
+        self._last_statistic = _NOT_CACHED
+
+    async def _async_get_cached_last_statistics(self) -> dict | None:
+        if self._last_statistic is _NOT_CACHED:
+            self._last_statistic = await self._async_get_last_statistics()
+
+        return self._last_statistic  # type: ignore[return-value]
+
+    async def _async_get_last_statistics(self) -> dict | None:
         def get_last_statistics():
             ret = statistics.get_last_statistics(
                 self.hass,
@@ -178,10 +375,71 @@ class StatisticsMixin(HistoricalSensor):
                 )
                 raise
 
-        latest = await recorder.get_instance(self.hass).async_add_executor_job(
+        return await recorder.get_instance(self.hass).async_add_executor_job(
             get_last_statistics
         )
 
+    async def async_calculate_statistic_data(
+        self,
+        hist_states: list[HistoricalState],
+        *,
+        latest: dict | None,
+        use_latest: bool = False,
+    ) -> list[StatisticData]:
+        #
+        # Filter out invalid states
+        #
+
+        n_original_hist_states = len(hist_states)
+        hist_states = [x for x in hist_states if x.state not in (0, None)]
+        if len(hist_states) != n_original_hist_states:
+            _LOGGER.warning(
+                f"{self.statistic_id}: "
+                + "found some weird values in historical statistics"
+            )
+
+        return await self.async_calculate_statistic_data_from_arrays(
+            array("q", (int(x.dt.timestamp()) for x in hist_states)),
+            array("d", (x.state for x in hist_states)),
+            latest=latest,
+            use_latest=use_latest,
+        )
+
+    async def async_calculate_statistic_data_from_arrays(
+        self,
+        timestamps: array,
+        values: array,
+        *,
+        latest: dict | None,
+        use_latest: bool = False,
+    ) -> list[StatisticData]:
+        """Statistics from valid (epoch seconds, state) pairs sorted by time"""
+
+        #
+        # Ignore supplied 'lastest' and use the cached one, recorder is only queried
+        # if cache has been invalidated.
+        # Supplied 'latest' is only used to detect statistics deleted or purged by
+        # someone else.
+        # FIXME: integrate into homeassistant_historical_sensor and remove
+        #
+
+        if not use_latest:
+            cached = await self._async_get_cached_last_statistics()
+            if cached and (
+                not latest
+                or latest["start"] < cached["start"]
+                # Same statistic but sums have been modified (i.e. a backfill)
+                or (
+                    latest["start"] == cached["start"]
+                    and latest.get("sum") != cached["sum"]
+                )
+            ):
+                _LOGGER.debug(f"{self.statistic_id}: statistics cache is outdated")
+                self.invalidate_statistics_cache()
+                cached = await self._async_get_cached_last_statistics()
+
+            latest = cached
+
         #
         # Get last sum sum from latest
         #
@@ -207,28 +465,17 @@ class StatisticsMixin(HistoricalSensor):
         )
 
         #
-        # Calculate statistic data
+        # Calculate statistic data, grouping historical states by hour block
         #
 
-        ret = []
+        ret = hourly_statistic_data(timestamps, values, base_sum=total_accumulated)
 
-        for dt, collection_it in itertools.groupby(
-            hist_states, key=hour_block_for_hist_state
-        ):
-            collection = list(collection_it)
-
-            # hour_mean = statistics.mean([x.state for x in collection])
-            hour_accumulated = sum([x.state for x in collection])
-            total_accumulated = total_accumulated + hour_accumulated
-
-            ret.append(
-                StatisticData(
-                    start=dt,
-                    state=hour_accumulated,
-                    # mean=hour_mean,
-                    sum=total_accumulated,
-                )
-            )
+        # Advance cached watermark, backfills don't write the last statistic
+        if ret and not use_latest:
+            self._last_statistic = {
+                "start": dt_util.as_timestamp(ret[-1]["start"]),
+                "sum": ret[-1]["sum"],
+            }
 
         return ret
 
@@ -331,8 +578,7 @@ class HistoricalConsumption(
             # FIXME: This should be None, fix ha-historical-sensor
             return []
 
-        ret = historical_states_from_period_values(data.periods)
-        return ret
+        return self._memoized_historical_states(data, historical_states_from_periods)
 
 
 class HistoricalGeneration(
@@ -368,8 +614,7 @@ class HistoricalGeneration(
             # FIXME: This should be None, fix ha-historical-sensor
             return []
 
-        ret = historical_states_from_period_values(data.periods)
-        return ret
+        return self._memoized_historical_states(data, historical_states_from_periods)
 
 
 class HistoricalPowerDemand(HistoricalSensorMixin, IDeEntity, SensorEntity):
@@ -390,14 +635,43 @@ class HistoricalPowerDemand(HistoricalSensorMixin, IDeEntity, SensorEntity):
             # FIXME: This should be None, fix ha-historical-sensor
             return []
 
-        def demand_at_instant_as_historical_state(item):
-            return HistoricalState(
-                state=item.value / 1000,
-                dt=item.dt.replace(tzinfo=MAINLAND_SPAIN_ZONEINFO),
-            )
+        return self._memoized_historical_states(data, historical_states_from_demands)
 
-        ret = [demand_at_instant_as_historical_state(x) for x in data.demands]
-        return ret
+
+class RequestBudget(IDeEntity, SensorEntity):
+    I_DE_PLATFORM = PLATFORM
+    I_DE_ENTITY_NAME = "Request Budget"
+    I_DE_DATA_SETS = []  # type: ignore[var-annotated]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._attr_entity_category = EntityCategory.DIAGNOSTIC
+        self._attr_native_unit_of_measurement = "requests"
+        self._attr_icon = "mdi:gauge"
+
+    @property
+    def state(self):
+        return self.coordinator.api.rate_limiter.remaining_day
+
+    @property
+    def extra_state_attributes(self):
+        rate_limiter = self.coordinator.api.rate_limiter
+
+        return {
+            "remaining_minute": rate_limiter.remaining_minute,
+            "per_minute": rate_limiter.per_minute,
+            "per_day": rate_limiter.per_day,
+        }
+
+    async def async_added_to_hass(self) -> None:
+        await super().async_added_to_hass()
+
+        # Account budget is shared with other entries, update on every request
+        self.async_on_remove(
+            self.coordinator.api.rate_limiter.async_add_listener(
+                self.async_write_ha_state
+            )
+        )
 
 
 async def async_setup_entry(
@@ -406,27 +680,51 @@ async def async_setup_entry(
     async_add_devices: AddEntitiesCallback,
     discovery_info: DiscoveryInfoType | None = None,  # noqa DiscoveryInfoType | None
 ):
-    coordinator, device_info = hass.data[DOMAIN][config_entry.entry_id]
-
+    coordinators, device_info, _ = hass.data[DOMAIN][config_entry.entry_id]
+
+    # Each sensor subscribes to the coordinator of its dataset
+    sensor_classes = [
+        AccumulatedConsumption,
+        InstantPowerDemand,
+        HistoricalConsumption,
+        HistoricalGeneration,
+        HistoricalPowerDemand,
+    ]
     sensors = [
-        AccumulatedConsumption(
-            config_entry=config_entry, device_info=device_info, coordinator=coordinator
-        ),
-        InstantPowerDemand(
-            config_entry=config_entry, device_info=device_info, coordinator=coordinator
-        ),
-        HistoricalConsumption(
-            config_entry=config_entry, device_info=device_info, coordinator=coordinator
-        ),
-        HistoricalGeneration(
-            config_entry=config_entry, device_info=device_info, coordinator=coordinator
-        ),
-        HistoricalPowerDemand(
-            config_entry=config_entry, device_info=device_info, coordinator=coordinator
-        ),
+        cls(
+            config_entry=config_entry,
+            device_info=device_info,
+            coordinator=coordinators[cls.I_DE_DATA_SETS[0]],
+        )
+        for cls in sensor_classes
     ]
+
+    # Request budget is account-wide, it doesn't need any dataset. Any coordinator
+    # gives access to the API client
+    sensors.append(
+        RequestBudget(
+            config_entry=config_entry,
+            device_info=device_info,
+            coordinator=coordinators[DataSetType.MEASURE],
+        )
+    )
     async_add_devices(sensors)
 
+    platform = entity_platform.async_get_current_platform()
+    platform.async_register_entity_service(
+        SERVICE_BACKFILL,
+        {
+            vol.Required("start"): cv.date,
+            vol.Optional("end"): cv.date,
+            vol.Optional("pace", default=BACKFILL_DEFAULT_PACE): vol.All(
+                vol.Coerce(float), vol.Range(min=0)
+            ),
+        },
+        "async_backfill",
+        # Only statistics sensors can be backfilled
+        required_features=[IDeEntityFeature.BACKFILL],
+    )
+
 
 def historical_states_from_historical_api_data(
     data: list[dict] | None = None,
@@ -445,24 +743,89 @@ def historical_states_from_historical_api_data(
     return [_convert_item(item) for item in data or []]
 
 
-def historical_states_from_period_values(
-    period_values: list[PeriodValue],
+def historical_states_from_periods(
+    periods: HistoricalPeriods,
 ) -> list[HistoricalState]:
     def fn():
-        for item in period_values:
-            # FIXME: What about canary islands?
-            dt = item.end.replace(tzinfo=MAINLAND_SPAIN_ZONEINFO)
-            last_reset = item.start.replace(tzinfo=MAINLAND_SPAIN_ZONEINFO)
-
+        for start, end, value in zip(periods.starts, periods.ends, periods.values):
             yield HistoricalState(
-                state=item.value / 1000,
-                dt=dt,
-                attributes={"last_reset": last_reset},
+                state=value / 1000,
+                dt=timestamp_as_local_datetime(end),
+                attributes={"last_reset": timestamp_as_local_datetime(start)},
             )
 
     return list(fn())
 
 
+def statistic_arrays_from_periods(periods: HistoricalPeriods) -> tuple[array, array]:
+    """(end, state) pairs of periods as arrays, invalid (zero) values dropped.
+
+    Same data historical_states_from_periods would feed to statistics.
+    """
+
+    timestamps, values = array("q"), array("d")
+    for end, value in zip(periods.ends, periods.values):
+        if value:
+            timestamps.append(end)
+            values.append(value / 1000)
+
+    return timestamps, values
+
+
+def hourly_statistic_data(
+    timestamps: array, values: array, *, base_sum: float = 0
+) -> list[StatisticData]:
+    """Group (epoch seconds, value) pairs, sorted by time, by hour block.
+
+    XX:00:00 values belong to the previous hour block.
+    """
+
+    ret: list[StatisticData] = []
+    total_accumulated = base_sum
+
+    block = None
+    hour_accumulated = 0.0
+
+    for ts, value in zip(timestamps, values):
+        ts_block = (ts - 1) // 3600 * 3600
+        if ts_block != block:
+            if block is not None:
+                total_accumulated = total_accumulated + hour_accumulated
+                ret.append(
+                    StatisticData(
+                        start=dt_util.utc_from_timestamp(block),
+                        state=hour_accumulated,
+                        sum=total_accumulated,
+                    )
+                )
+
+            block = ts_block
+            hour_accumulated = 0.0
+
+        hour_accumulated = hour_accumulated + value
+
+    if block is not None:
+        total_accumulated = total_accumulated + hour_accumulated
+        ret.append(
+            StatisticData(
+                start=dt_util.utc_from_timestamp(block),
+                state=hour_accumulated,
+                sum=total_accumulated,
+            )
+        )
+
+    return ret
+
+
+def historical_states_from_demands(
+    demands: HistoricalDemands,
+) -> list[HistoricalState]:
+    return [
+        HistoricalState(state=value / 1000, dt=timestamp_as_local_datetime(ts))
+        for ts, value in zip(demands.timestamps, demands.values)
+    ]
+
+
 async def async_get_last_state_safe(
     entity: RestoreEntity, convert_fn: Callable[[Any], Any]
 ) -> Any:
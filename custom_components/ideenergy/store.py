@@ -0,0 +1,67 @@
+# Copyright (C) 2021-2022 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from typing import Any
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+
+STORE_VERSION = 1
+STORE_SAVE_DELAY = 10
+
+
+class StoredDict:
+    """Dict of JSON serializable values persisted into a Home Assistant Store.
+
+    Use a singleton getter (homeassistant.helpers.singleton) to load it once.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        key: str,
+        *,
+        private: bool = False,
+        save_delay: int = STORE_SAVE_DELAY,
+    ):
+        self._store: Store[dict[str, Any]] = Store(
+            hass, STORE_VERSION, key, private=private
+        )
+        self._save_delay = save_delay
+        self._data: dict[str, Any] = {}
+
+    async def async_load(self) -> None:
+        self._data = await self._store.async_load() or {}
+
+    def get(self, key: str) -> Any | None:
+        return self._data.get(key)
+
+    def set(self, key: str, value: Any | None) -> None:
+        """Set (or remove if value is None) key, saved after a delay"""
+
+        if value is None:
+            self._data.pop(key, None)
+        else:
+            self._data[key] = value
+
+        self._store.async_delay_save(lambda: self._data, self._save_delay)
+
+    async def async_save(self) -> None:
+        """Save now, cancels any delayed save"""
+
+        await self._store.async_save(self._data)